@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+from aiogram import types
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows at most 10 items in an album
+MAX_ALBUM_SIZE = 10
+
+ALBUM_MEDIA = {
+    types.ContentType.PHOTO: types.InputMediaPhoto,
+    types.ContentType.VIDEO: types.InputMediaVideo,
+    types.ContentType.DOCUMENT: types.InputMediaDocument,
+    types.ContentType.AUDIO: types.InputMediaAudio,
+}
+
+
+def input_media(message: types.Message):
+    """InputMedia that resends an album item by file_id, caption included."""
+    content_type = message.content_type
+    file = message.photo[-1] if content_type == types.ContentType.PHOTO else getattr(message, content_type)
+    caption = message.html_text if message.caption else None
+    return ALBUM_MEDIA[content_type](media=file.file_id, caption=caption)
+
+
+class AlbumBuffer:
+    """Collects the items of a media group, which Telegram delivers as separate updates.
+
+    An album is passed to `on_album(messages)` once no new item arrived for
+    `delay` seconds, or as soon as it is full, so it can be resent with a
+    single sendMediaGroup call.
+    """
+
+    def __init__(self, on_album, delay=0.5):
+        self.on_album = on_album
+        self.delay = delay
+        # media_group_id -> [messages, flush timer]
+        self._albums = {}
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._albums)
+
+    def add(self, message: types.Message):
+        album = self._albums.get(message.media_group_id)
+        if album is None:
+            album = self._albums[message.media_group_id] = [[], None]
+        else:
+            album[1].cancel()
+        album[0].append(message)
+
+        if len(album[0]) >= MAX_ALBUM_SIZE:
+            self._flush(message.media_group_id)
+        else:
+            album[1] = asyncio.get_running_loop().call_later(self.delay, self._flush, message.media_group_id)
+
+    def _flush(self, media_group_id):
+        messages, timer = self._albums.pop(media_group_id)
+        timer.cancel()
+        # Updates handled concurrently may have been added out of order
+        messages.sort(key=lambda message: message.message_id)
+        task = asyncio.create_task(self.on_album(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to relay album: {task.exception()!r}")
+
+    async def close(self):
+        for media_group_id in list(self._albums):
+            self._flush(media_group_id)
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
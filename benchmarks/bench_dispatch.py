@@ -0,0 +1,119 @@
+# Benchmark: per-update dispatch cost, aiogram filter chain vs Router table.
+#
+#   python benchmarks/bench_dispatch.py [updates]
+#
+# Both dispatchers get the same ten handlers as no-ops, registered the old way
+# (text=/state=/content_types= filters, walked in order) and through Router,
+# so the timings hold only the cost of finding the handler. The update mix is
+# mostly chat text, the relay hot path, plus button presses. Building and
+# serializing a keyboard per reply is compared with sending the prebuilt JSON.
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.update(BOT_TOKEN="123456:BENCHMARK", STORAGE_BACKEND="memory")
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.utils.payload import prepare_arg
+
+import bot
+from bot import ChatState
+from router import Router
+
+USERS = 1_000
+
+
+async def noop(message):
+    pass
+
+
+def legacy_dispatcher():
+    dp = Dispatcher(bot.bot, storage=MemoryStorage())
+    dp.register_message_handler(noop, commands=['start', 'help'], state='*')
+    dp.register_message_handler(noop, text="ℹ️ Help", state='*')
+    dp.register_message_handler(noop, text="🚀 Start Chat", state=ChatState.idle)
+    dp.register_message_handler(noop, text="❌ Cancel Search", state=ChatState.searching)
+    dp.register_message_handler(noop, text="⏭️ Next Partner", state=ChatState.chatting)
+    dp.register_message_handler(noop, text="⏹️ End Chat", state='*')
+    dp.register_message_handler(noop, state=ChatState.chatting, content_types=types.ContentTypes.TEXT)
+    dp.register_message_handler(noop, state=ChatState.chatting, content_types=types.ContentTypes.ANY)
+    dp.register_message_handler(noop, state=ChatState.searching, content_types=types.ContentTypes.ANY)
+    dp.register_message_handler(noop, content_types=types.ContentTypes.ANY, state='*')
+    return dp
+
+
+def routed_dispatcher():
+    dp = Dispatcher(bot.bot, storage=MemoryStorage())
+    router = Router(dp)
+    router.text('/start', '/help')(noop)
+    router.text("ℹ️ Help")(noop)
+    router.text("🚀 Start Chat", state=ChatState.idle)(noop)
+    router.text("❌ Cancel Search", state=ChatState.searching)(noop)
+    router.text("⏭️ Next Partner", state=ChatState.chatting)(noop)
+    router.text("⏹️ End Chat")(noop)
+    router.content(types.ContentType.TEXT, state=ChatState.chatting)(noop)
+    router.content(state=ChatState.chatting)(noop)
+    router.content(state=ChatState.searching)(noop)
+    router.content()(noop)
+    router.install()
+    return dp
+
+
+def make_updates(count):
+    texts = ["hello there"] * 8 + ["⏹️ End Chat", "ℹ️ Help"]
+    updates = []
+    for i in range(count):
+        user_id = i % USERS + 1
+        updates.append(types.Update(**{"update_id": i, "message": {
+            "message_id": i, "date": 0, "text": texts[i % len(texts)],
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"}}}))
+    return updates
+
+
+async def time_dispatch(dp, updates):
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    for user_id in range(1, USERS + 1):
+        await dp.storage.set_state(chat=user_id, user=user_id, state=ChatState.chatting)
+
+    start = time.perf_counter()
+    for update in updates:
+        await dp.process_update(update)
+    return (time.perf_counter() - start) / len(updates)
+
+
+def time_keyboards(count):
+    start = time.perf_counter()
+    for _ in range(count):
+        keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        keyboard.add(types.KeyboardButton("⏭️ Next Partner"))
+        keyboard.add(types.KeyboardButton("⏹️ End Chat"))
+        prepare_arg(keyboard)
+    rebuilt = (time.perf_counter() - start) / count
+
+    start = time.perf_counter()
+    for _ in range(count):
+        prepare_arg(bot.CHATTING_KEYBOARD)
+    prebuilt = (time.perf_counter() - start) / count
+    return rebuilt, prebuilt
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    updates = make_updates(count)
+
+    legacy = asyncio.run(time_dispatch(legacy_dispatcher(), updates))
+    routed = asyncio.run(time_dispatch(routed_dispatcher(), updates))
+    print(f"dispatch  filter chain: {legacy * 1e6:7.1f}us/update   router: {routed * 1e6:7.1f}us/update")
+
+    rebuilt, prebuilt = time_keyboards(count)
+    print(f"keyboard  rebuilt:      {rebuilt * 1e6:7.1f}us/reply    prebuilt: {prebuilt * 1e6:7.1f}us/reply")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Micro-benchmark: matchmaking latency against the size of the search queue.
+#
+#   python benchmarks/bench_matchmaker.py
+#
+# For each queue size the queue is pre-filled with waiting users, then we time
+# cancel (a random user leaves), discard (/start or End Chat) and enqueue
+# (a newcomer is paired with the oldest user). The old list-based code is timed
+# alongside for comparison.
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaker import Matchmaker
+
+SIZES = (10, 100, 1_000, 10_000, 100_000)
+OPS = 2_000
+
+
+def bench_matchmaker(size):
+    mm = Matchmaker()
+    for user_id in range(size):
+        mm._waiting[user_id] = 0.0
+    victims = random.sample(range(size), min(OPS, size))
+
+    start = time.perf_counter()
+    for user_id in victims:
+        mm.cancel(user_id)
+        mm._waiting[user_id] = 0.0
+    cancel = (time.perf_counter() - start) / len(victims)
+
+    start = time.perf_counter()
+    for user_id in victims:
+        mm.discard(user_id)
+        mm._waiting[user_id] = 0.0
+    discard = (time.perf_counter() - start) / len(victims)
+
+    start = time.perf_counter()
+    for i in range(OPS):
+        mm.enqueue(size + i)
+    enqueue = (time.perf_counter() - start) / OPS
+
+    return cancel, discard, enqueue
+
+
+def bench_list(size):
+    waiting_users = list(range(size))
+    victims = random.sample(range(size), min(OPS, size))
+
+    start = time.perf_counter()
+    for user_id in victims:
+        if user_id in waiting_users:
+            waiting_users.remove(user_id)
+        waiting_users.append(user_id)
+    cancel = (time.perf_counter() - start) / len(victims)
+
+    start = time.perf_counter()
+    for i in range(OPS):
+        waiting_users.append(size + i)
+        if len(waiting_users) >= 2:
+            waiting_users.pop(0)
+            waiting_users.pop(0)
+            waiting_users.append(i)
+    enqueue = (time.perf_counter() - start) / OPS
+
+    return cancel, enqueue
+
+
+def main():
+    print(f"{'waiting':>8} | {'cancel':>9} {'discard':>9} {'enqueue':>9} | {'list cancel':>11} {'list enqueue':>12}")
+    for size in SIZES:
+        cancel, discard, enqueue = bench_matchmaker(size)
+        list_cancel, list_enqueue = bench_list(size)
+        print(f"{size:>8} | {cancel * 1e9:>7.0f}ns {discard * 1e9:>7.0f}ns {enqueue * 1e9:>7.0f}ns | "
+              f"{list_cancel * 1e9:>9.0f}ns {list_enqueue * 1e9:>10.0f}ns")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Benchmark: relay throughput of the sharded worker mode by number of workers.
+#
+#   python benchmarks/bench_shards.py [pairs] [messages]
+#
+# Bot API calls are answered in-process (no network), so the numbers measure
+# the CPU cost of dispatching and relaying, the part that shards spread
+# across cores. Expect throughput to grow with workers up to the core count.
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.update(BOT_TOKEN="123456:BENCHMARK", STORAGE_BACKEND="memory",
+                  SEND_GLOBAL_RATE="1e9", SEND_CHAT_RATE="1e9", SEND_CHAT_BURST="1000000000")
+
+from aiogram import Bot
+
+import bot
+from shards import Broker
+
+WORKER_COUNTS = (1, 2, 4, 8)
+
+
+async def fake_request(self, method, data=None, *args, **kwargs):
+    return {"message_id": 1, "date": 0, "chat": {"id": int(data["chat_id"]), "type": "private"}}
+
+Bot.request = fake_request
+
+
+def make_update(update_id, user_id, text):
+    message = {"message_id": update_id, "date": 0, "text": text,
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": "user"}}
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+async def run(broker, pairs, messages):
+    broker.attach()
+    users = range(1, pairs * 2 + 1)
+
+    for text in ('/start', '🚀 Start Chat'):
+        for user_id in users:
+            broker.feed(make_update(0, user_id, text))
+        await broker.drain()
+    # Pair events travel broker -> shard after the Start Chat updates are handled
+    await asyncio.sleep(0.5)
+    await broker.drain()
+
+    start = time.perf_counter()
+    for i in range(messages):
+        broker.feed(make_update(i, users[i % len(users)], f"message {i}"))
+    await broker.drain()
+    elapsed = time.perf_counter() - start
+
+    await broker.stop()
+    return messages / elapsed
+
+
+def main():
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    print(f"{pairs} pairs, {messages} relayed messages, {os.cpu_count()} CPUs")
+    for workers in WORKER_COUNTS:
+        broker = Broker(bot.dp, workers, on_worker_start=bot.init_shard)
+        broker.start()
+        rate = asyncio.run(run(broker, pairs, messages))
+        print(f"{workers:>2} workers: {rate:>9.0f} msg/s")
+
+
+if __name__ == '__main__':
+    main()
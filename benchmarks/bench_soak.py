@@ -0,0 +1,174 @@
+# Soak test: 24 simulated hours of users coming and going, with and without the reaper.
+#
+#   python benchmarks/bench_soak.py [hours] [arrivals per minute]
+#
+# Runs the real Matchmaker, MemoryStorage and Reaper on a simulated clock,
+# without a bot. Users press /start, search, chat for a while and leave: some
+# press End Chat, most simply stop answering (close the app or block the
+# bot), which the bot is never told about. Every few simulated hours the
+# tracked users, FSM records, queue, pairs and the memory held by them are
+# printed (what tracemalloc attributes to the matchmaker, reaper and storage).
+# Without the reaper every visitor leaves state behind; with it the state
+# stays proportional to the users active within the timeouts.
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaker import Matchmaker
+from metrics import RECLAIMED
+from reaper import Reaper
+from storage import MemoryStorage
+
+SEARCH_TIMEOUT = 600
+CHAT_TIMEOUT = 1800
+IDLE_TIMEOUT = 3600
+REPORT_EVERY = 4 * 3600
+STATE_FILES = [tracemalloc.Filter(True, pattern) for pattern in
+               ("*/matchmaker.py", "*/reaper.py", "*/storage.py", "*/fsm_storage/memory.py")]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Soak:
+    def __init__(self, hours, arrivals, reaper_enabled):
+        self.clock = Clock()
+        self.end = hours * 3600
+        self.arrivals = arrivals / 60
+        self.matchmaker = Matchmaker(clock=self.clock)
+        self.storage = MemoryStorage()
+        timeouts = (SEARCH_TIMEOUT, CHAT_TIMEOUT, IDLE_TIMEOUT) if reaper_enabled else (0, 0, 0)
+        self.reaper = Reaper(self.matchmaker, self.storage, *timeouts, on_expire=self.on_expire, clock=self.clock)
+        self.matchmaker.on_relay = self.reaper.touch
+        self.events = []
+        self.seq = itertools.count()
+        self.user_ids = itertools.count(1)
+        self.gone = set()
+        self.messages_left = {}
+        self.visitors = 0
+
+    def at(self, delay, action, user_id):
+        heapq.heappush(self.events, (self.clock.now + delay, next(self.seq), action, user_id))
+
+    async def set_state(self, user_id, state):
+        await self.storage.set_state(chat=user_id, user=user_id, state=state)
+
+    def leave(self, user_id):
+        """The user stops answering; the bot is not told."""
+        self.gone.add(user_id)
+        self.messages_left.pop(user_id, None)
+
+    def next_step(self, user_id, search_again):
+        if random.random() < search_again:
+            self.at(random.uniform(2, 30), self.search, user_id)
+        else:
+            self.leave(user_id)
+
+    # User actions, each one a message the bot receives
+
+    async def start(self, user_id):
+        self.reaper.touch(user_id)
+        await self.set_state(user_id, "ChatState:idle")
+        self.at(random.uniform(2, 10), self.search, user_id)
+
+    async def search(self, user_id):
+        self.reaper.touch(user_id)
+        pair = self.matchmaker.enqueue(user_id)
+        await self.set_state(user_id, "ChatState:searching")
+        if pair:
+            for member in pair:
+                await self.set_state(member, "ChatState:chatting")
+                self.reaper.touch(member)
+                if member not in self.gone:
+                    self.messages_left[member] = random.randint(1, 40)
+                    self.at(random.uniform(5, 60), self.message, member)
+        elif random.random() < 0.15:
+            # Gives up on the search without pressing Cancel
+            self.leave(user_id)
+
+    async def message(self, user_id):
+        if user_id in self.gone or self.matchmaker.partner_of(user_id) is None:
+            return
+        self.reaper.touch(user_id)
+        self.matchmaker.relayed(user_id, self.matchmaker.partner_of(user_id))
+        self.messages_left[user_id] -= 1
+        if self.messages_left[user_id] > 0:
+            self.at(random.uniform(5, 60), self.message, user_id)
+        elif random.random() < 0.4:
+            await self.end_chat(user_id)
+        else:
+            self.leave(user_id)
+
+    async def end_chat(self, user_id):
+        partner_id = self.matchmaker.discard(user_id)
+        await self.set_state(user_id, "ChatState:idle")
+        self.messages_left.pop(user_id, None)
+        if partner_id is not None and partner_id not in self.gone:
+            self.messages_left.pop(partner_id, None)
+            self.next_step(partner_id, search_again=0.5)
+        self.next_step(user_id, search_again=0.3)
+
+    async def on_expire(self, kind, user_id, partner_id):
+        self.leave(user_id)
+        if partner_id is not None and partner_id not in self.gone:
+            self.messages_left.pop(partner_id, None)
+            self.next_step(partner_id, search_again=0.5)
+
+    def snapshot(self):
+        records = sum(map(len, self.storage.data.values()))
+        heap = sum(stat.size for stat in
+                   tracemalloc.take_snapshot().filter_traces(STATE_FILES).statistics('filename'))
+        return (f"{self.clock.now / 3600:5.0f}h  visitors {self.visitors:7d}  tracked {len(self.reaper):6d}  "
+                f"records {records:7d}  waiting {len(self.matchmaker):5d}  pairs {self.matchmaker.pair_count:6d}  "
+                f"state {heap / 2**20:6.2f} MiB")
+
+    async def run(self):
+        next_arrival = random.expovariate(self.arrivals)
+        for second in range(1, self.end + 1):
+            self.clock.now = float(second)
+            while next_arrival <= self.clock.now:
+                self.visitors += 1
+                self.at(next_arrival - self.clock.now, self.start, next(self.user_ids))
+                next_arrival += random.expovariate(self.arrivals)
+            while self.events and self.events[0][0] <= self.clock.now:
+                _, _, action, user_id = heapq.heappop(self.events)
+                await action(user_id)
+            await self.reaper.reap()
+            # Lets the notification tasks started by the reaper run
+            await asyncio.sleep(0)
+            if second % REPORT_EVERY == 0:
+                print(self.snapshot())
+
+
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    arrivals = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    for reaper_enabled in (False, True):
+        random.seed(1)
+        tracemalloc.start()
+        soak = Soak(hours, arrivals, reaper_enabled)
+        print(f"reaper {'on' if reaper_enabled else 'off'}, {hours}h, {arrivals:g} new users/min")
+        start = time.perf_counter()
+        asyncio.run(soak.run())
+        tracemalloc.stop()
+        if reaper_enabled:
+            reclaimed = ", ".join(f"{kind} {count}" for (kind,), count in RECLAIMED._values.items())
+            print(f"reclaimed: {reclaimed}")
+        print(f"simulated in {time.perf_counter() - start:.1f}s\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Local stand-in for the Telegram Bot API, for load tests without a real token.
+#
+#   python benchmarks/fake_api.py --port 8081 [--latency 0.05] [--flood-rate 0.01]
+#
+# Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8081. Updates
+# are delivered through getUpdates, or POSTed to the webhook once the bot
+# calls setWebhook. Every outgoing call can be delayed by `latency` seconds,
+# and `flood_rate` of the send calls are answered with 429 and retry_after.
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import random
+import time
+
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger(__name__)
+
+SEND_METHODS = {'sendmessage', 'copymessage', 'sendmediagroup', 'sendphoto', 'senddocument', 'sendsticker'}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1, on_send=None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        # on_send(method, params) is called for every accepted send call
+        self.on_send = on_send
+
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.calls = collections.Counter()
+        self.floods = 0
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._session = None
+        self._runner = None
+        self._deliveries = set()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self._handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._session = ClientSession()
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._deliveries:
+            await asyncio.wait(list(self._deliveries), timeout=5)
+        await self._session.close()
+        await self._runner.cleanup()
+
+    def push_message(self, user_id, text):
+        """Deliver a text message from `user_id` to the bot."""
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "text": text,
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.push_update({"message": message})
+
+    def push_update(self, update):
+        update = dict(update, update_id=next(self._update_ids))
+        if self.webhook_url:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+
+    async def _deliver(self, update):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+        try:
+            async with self._session.post(self.webhook_url, json=update, headers=headers) as response:
+                if response.status != 200:
+                    logger.warning(f"Webhook answered {response.status}")
+        except Exception as e:
+            logger.warning(f"Webhook delivery failed: {e}")
+
+    async def _handle(self, request):
+        method = request.match_info['method'].lower()
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] += 1
+
+        if method == 'getupdates':
+            return self._ok(await self._get_updates(params))
+        if method == 'getme':
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        if method == 'setwebhook':
+            self.webhook_url = params.get('url')
+            self.webhook_secret = params.get('secret_token')
+            return self._ok(True)
+        if method == 'deletewebhook':
+            self.webhook_url = None
+            return self._ok(True)
+        if method == 'getwebhookinfo':
+            return self._ok({"url": self.webhook_url or "", "has_custom_certificate": False,
+                             "pending_update_count": 0 if self.webhook_url else len(self._updates)})
+        if method not in SEND_METHODS:
+            return self._ok(True)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+
+        if self.on_send is not None:
+            self.on_send(method, params)
+        if method == 'sendmediagroup':
+            media = json.loads(params.get('media', '[]'))
+            return self._ok([self._message(params) for _ in media])
+        if method == 'copymessage':
+            return self._ok({"message_id": next(self._message_ids)})
+        return self._ok(self._message(params))
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        if offset < 0:
+            # skip_updates asks for the last update only
+            updates, self._updates = self._updates[-1:], []
+            return updates
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get('timeout', 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit', 100) or 100)
+        return self._updates[:limit]
+
+    def _message(self, params):
+        chat_id = int(params.get('chat_id', 0))
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get('text', '')}
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+
+async def serve(args):
+    api = FakeBotAPI(latency=args.latency, flood_rate=args.flood_rate)
+    await api.start(args.host, args.port)
+    print(f"Fake Bot API on http://{args.host}:{args.port}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every send call")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="fraction of send calls answered with 429")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Load test: bot.py against the fake Bot API with thousands of virtual users.
+#
+#   python benchmarks/loadtest.py --users 2000 --rounds 3 --messages 5 [--mode webhook] [--workers 4]
+#
+# Each virtual user sends /start, presses Start Chat, exchanges `messages`
+# texts with whoever it is paired with, presses Next Partner, and after
+# `rounds` chats presses End Chat. Users react only to what the bot sends
+# them, so the numbers cover the whole path: update delivery, matchmaking,
+# relaying and the send queue. The bot runs as a separate process with
+# Telegram's flood limits raised (see --global-rate/--chat-rate) so the
+# bot's own capacity is what gets measured.
+import argparse
+import asyncio
+import os
+import random
+import signal
+import sys
+import time
+
+from fake_api import FakeBotAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PARTNER_GONE = ("⚠️ Your partner left the chat.", "❌ Chat ended by partner.", "⚠️ Your partner disconnected.")
+
+
+class VirtualUser:
+    __slots__ = ('user_id', 'rounds_left', 'search_started', 'chat_task', 'done')
+
+    def __init__(self, user_id, rounds):
+        self.user_id = user_id
+        self.rounds_left = rounds
+        self.search_started = None
+        self.chat_task = None
+        self.done = False
+
+
+class Simulator:
+    def __init__(self, api, users, rounds, messages, interval):
+        self.api = api
+        self.messages = messages
+        self.interval = interval
+        self.users = {user_id: VirtualUser(user_id, rounds) for user_id in range(1, users + 1)}
+        self.remaining = users
+        self.pushed = 0
+        self.pairing = []
+        self.relay = []
+        self.last_event = time.monotonic()
+        api.on_send = self.on_send
+
+    def push(self, user, text):
+        self.api.push_message(user.user_id, text)
+        self.pushed += 1
+
+    def start(self):
+        for user in self.users.values():
+            self.push(user, "/start")
+
+    def search(self, user):
+        user.search_started = time.monotonic()
+        self.push(user, "🚀 Start Chat")
+
+    def finish(self, user):
+        if not user.done:
+            user.done = True
+            self.remaining -= 1
+
+    def on_send(self, method, params):
+        if method != 'sendmessage':
+            return
+        user = self.users.get(int(params['chat_id']))
+        if user is None or user.done:
+            return
+        now = self.last_event = time.monotonic()
+        text = params.get('text', '')
+
+        if text.startswith("👤: hello "):
+            self.relay.append(now - float(text.rsplit(maxsplit=1)[-1]))
+        elif "Welcome to" in text or text.startswith("⚠️ No active partner found."):
+            self.search(user)
+        elif text.startswith("💬 You're now connected!"):
+            self.pairing.append(now - user.search_started)
+            user.rounds_left -= 1
+            user.chat_task = asyncio.create_task(self.chat(user))
+        elif text.startswith(PARTNER_GONE) and user.chat_task is not None:
+            # Ignored when the user already left on their own
+            user.chat_task.cancel()
+            user.chat_task = None
+            if user.rounds_left > 0:
+                self.search(user)
+            else:
+                self.finish(user)
+
+    async def chat(self, user):
+        for _ in range(self.messages):
+            await asyncio.sleep(self.interval * random.uniform(0.5, 1.5))
+            self.push(user, f"hello {time.monotonic()}")
+        user.chat_task = None
+        if user.rounds_left > 0:
+            user.search_started = time.monotonic()
+            self.push(user, "⏭️ Next Partner")
+        else:
+            self.push(user, "⏹️ End Chat")
+            self.finish(user)
+
+
+def rss_kb(pid):
+    """Resident memory of `pid` and its child processes, in KiB."""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                total += rss_kb(int(child))
+    except FileNotFoundError:
+        pass
+    return total
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.latency, flood_rate=args.flood_rate)
+    await api.start('127.0.0.1', args.api_port)
+
+    env = dict(os.environ, BOT_TOKEN="123456:LOADTEST", TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+               BOT_MODE=args.mode, WEBHOOK_HOST=f"http://127.0.0.1:{args.webhook_port}", PORT=str(args.webhook_port),
+               WORKERS=str(args.workers), STORAGE_BACKEND="memory", METRICS_PORT="0", LOG_LEVEL="WARNING",
+               SEND_GLOBAL_RATE=str(args.global_rate), SEND_CHAT_RATE=str(args.chat_rate),
+               SEND_CHAT_BURST=str(max(3, int(args.chat_rate))))
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "bot.py"), env=env, cwd=ROOT)
+
+    while not (api.webhook_url if args.mode == 'webhook' else api.calls['getupdates']):
+        if process.returncode is not None:
+            raise SystemExit("bot.py exited during startup")
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(0.5)
+    base_rss = rss_kb(process.pid)
+
+    sim = Simulator(api, args.users, args.rounds, args.messages, args.interval)
+    start = time.monotonic()
+    sim.start()
+    peak_rss = base_rss
+    while sim.remaining and time.monotonic() - sim.last_event < args.idle_timeout:
+        await asyncio.sleep(0.5)
+        peak_rss = max(peak_rss, rss_kb(process.pid))
+    elapsed = sim.last_event - start
+
+    process.send_signal(signal.SIGTERM)
+    await process.wait()
+    await api.stop()
+
+    print(f"users {args.users}, {args.workers} worker(s), {args.mode}, finished {args.users - sim.remaining}")
+    print(f"elapsed          {elapsed:8.2f}s")
+    print(f"updates/s        {sim.pushed / elapsed:8.0f}   ({sim.pushed} updates)")
+    print(f"bot sends/s      {sum(api.calls[m] for m in ('sendmessage', 'copymessage')) / elapsed:8.0f}"
+          f"   (429 injected: {api.floods})")
+    print(f"pairing latency  p50 {percentile(sim.pairing, 0.5) * 1000:8.1f}ms   "
+          f"p99 {percentile(sim.pairing, 0.99) * 1000:8.1f}ms   ({len(sim.pairing)} pairings)")
+    print(f"relay latency    p50 {percentile(sim.relay, 0.5) * 1000:8.1f}ms   "
+          f"p99 {percentile(sim.relay, 0.99) * 1000:8.1f}ms   ({len(sim.relay)} relays)")
+    print(f"memory           {base_rss / 1024:.1f} MiB idle, {peak_rss / 1024:.1f} MiB peak, "
+          f"{(peak_rss - base_rss) / args.users:.2f} KiB/user")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test bot.py against a fake Bot API")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3, help="chats per user")
+    parser.add_argument('--messages', type=int, default=5, help="messages per user per chat")
+    parser.add_argument('--interval', type=float, default=0.5, help="mean seconds between a user's messages")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help="fake Bot API latency in seconds")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument('--global-rate', type=float, default=100_000)
+    parser.add_argument('--chat-rate', type=float, default=1_000)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8082)
+    parser.add_argument('--idle-timeout', type=float, default=10, help="stop after this long without bot output")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
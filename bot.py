@@ -1,23 +1,40 @@
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated
+import asyncio
+import json
 import logging
-import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+import signal
+
+import config
+import metrics
+from albums import ALBUM_MEDIA, AlbumBuffer, input_media
+from logs import setup_logging
+from matchmaker import Matchmaker
+from reaper import SEARCHING, Reaper
+from router import Router
+from sender import RELAY, SendScheduler
+from shards import Broker, RemoteMatchmaker
+from storage import create_storage, rebalance, shard_path
+from webhook import run_webhook
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+setup_logging(config.LOG_LEVEL, config.LOG_SAMPLE_RATE, config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 # Initialize bot
-bot = Bot(token=BOT_TOKEN, parse_mode=types.ParseMode.HTML)
-storage = MemoryStorage()
+api_server = TelegramAPIServer.from_base(config.TELEGRAM_API_URL) if config.TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+bot = Bot(token=config.BOT_TOKEN, parse_mode=types.ParseMode.HTML, server=api_server)
+sender = SendScheduler(bot, global_rate=config.SEND_GLOBAL_RATE, chat_rate=config.SEND_CHAT_RATE,
+                       chat_burst=config.SEND_CHAT_BURST, max_retries=config.SEND_MAX_RETRIES)
+if config.STORAGE_BACKEND == "sqlite":
+    # Users are split between the state files by id, split them again if WORKERS changed
+    rebalance(config.STORAGE_PATH, config.WORKERS)
+# In sharded mode each worker opens its own state file and the broker keeps none
+storage = create_storage(config.STORAGE_BACKEND if config.WORKERS == 1 else "memory", config.STORAGE_PATH,
+                         config.STORAGE_FLUSH_INTERVAL)
 dp = Dispatcher(bot, storage=storage)
 
 # States
@@ -26,36 +43,49 @@ class ChatState(StatesGroup):
     searching = State()
     chatting = State()
 
+router = Router(dp, default_state=ChatState.idle)
+
 # Data storage
-waiting_users = []
-active_pairs = {}
+matchmaker = Matchmaker()
+storage.attach(matchmaker)
 
-# Keyboards
-def get_main_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton("🚀 Start Chat"))
-    keyboard.add(types.KeyboardButton("ℹ️ Help"))
-    return keyboard
+metrics.ACTIVE_PAIRS.fn = lambda: matchmaker.pair_count
+metrics.WAITING_USERS.fn = lambda: len(matchmaker)
+metrics.SEND_QUEUE_DEPTH.fn = lambda: sender.pending
+metrics.TRACKED_USERS.fn = lambda: len(reaper)
 
-def get_searching_keyboard():
+# Keyboards are built and serialized once, the JSON is sent as is
+def build_keyboard(*buttons):
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton("❌ Cancel Search"))
-    return keyboard
+    for text in buttons:
+        keyboard.add(types.KeyboardButton(text))
+    return json.dumps(keyboard.to_python())
 
-def get_chatting_keyboard():
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(types.KeyboardButton("⏭️ Next Partner"))
-    keyboard.add(types.KeyboardButton("⏹️ End Chat"))
-    return keyboard
+MAIN_KEYBOARD = build_keyboard("🚀 Start Chat", "ℹ️ Help")
+SEARCHING_KEYBOARD = build_keyboard("❌ Cancel Search")
+CHATTING_KEYBOARD = build_keyboard("⏭️ Next Partner", "⏹️ End Chat")
 
 # Messages
-WELCOME_MSG = """
-👋 Welcome to <b>Anonymous Text Chat</b>!
-📝 Only text messages are allowed.
+CONTENT_NAMES = {
+    "photo": "photos", "video": "videos", "animation": "GIFs", "sticker": "stickers", "voice": "voice notes",
+    "video_note": "video messages", "audio": "music", "document": "files", "location": "locations",
+    "venue": "places", "contact": "contacts", "poll": "polls", "dice": "dice",
+}
+
+def describe_relayed(content_types):
+    """What users can send their partner, e.g. "text, photos and stickers"."""
+    names = ["text"] + [CONTENT_NAMES[content_type] for content_type in content_types]
+    return names[0] if len(names) == 1 else f"{', '.join(names[:-1])} and {names[-1]}"
+
+RELAYED = describe_relayed(config.RELAY_CONTENT_TYPES)
+
+WELCOME_MSG = f"""
+👋 Welcome to <b>Anonymous Chat</b>!
+📎 Send {RELAYED}, your profile stays hidden.
 🚀 Press <b>Start Chat</b> to begin!
 """
 
-HELP_MSG = """
+HELP_MSG = f"""
 <b>📚 Help Guide</b>
 
 <b>🚀 Start Chat</b> - Find a random partner  
@@ -63,147 +93,305 @@ HELP_MSG = """
 <b>⏹️ End Chat</b> - End current chat  
 <b>❌ Cancel Search</b> - Stop searching  
 
-Only text messages are supported.
+You can send your partner {RELAYED}, they never see your profile.
 """
 
 # Handlers
-@dp.message_handler(commands=['start', 'help'], state='*')
+@router.text('/start', '/help')
 async def send_welcome(message: types.Message):
     user_id = message.from_user.id
 
-    partner_id = active_pairs.get(user_id)
+    partner_id = matchmaker.discard(user_id)
     if partner_id:
-        active_pairs.pop(partner_id, None)
         try:
-            await bot.send_message(partner_id, "⚠️ Your partner disconnected.", reply_markup=get_main_keyboard())
+            await sender.send_message(partner_id, "⚠️ Your partner disconnected.", reply_markup=MAIN_KEYBOARD)
         except (BotBlocked, ChatNotFound, UserDeactivated) as e:
             logger.warning(f"Failed to notify partner {partner_id}: {e}")
 
-    active_pairs.pop(user_id, None)
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
-
     await ChatState.idle.set()
-    await message.answer(WELCOME_MSG, reply_markup=get_main_keyboard())
+    await sender.answer(message, WELCOME_MSG, reply_markup=MAIN_KEYBOARD)
 
-@dp.message_handler(text="ℹ️ Help", state='*')
+@router.text("ℹ️ Help")
 async def show_help(message: types.Message):
     current_state = await dp.current_state(user=message.from_user.id).get_state()
     if current_state == ChatState.chatting.state:
-        await message.answer(HELP_MSG, reply_markup=get_chatting_keyboard())
+        await sender.answer(message, HELP_MSG, reply_markup=CHATTING_KEYBOARD)
     elif current_state == ChatState.searching.state:
-        await message.answer(HELP_MSG, reply_markup=get_searching_keyboard())
+        await sender.answer(message, HELP_MSG, reply_markup=SEARCHING_KEYBOARD)
     else:
-        await message.answer(HELP_MSG, reply_markup=get_main_keyboard())
+        await sender.answer(message, HELP_MSG, reply_markup=MAIN_KEYBOARD)
 
-@dp.message_handler(text="🚀 Start Chat", state=ChatState.idle)
-async def start_search(message: types.Message):
-    user_id = message.from_user.id
+async def sync_state(user_id):
+    """Match the FSM state of a user whose pair ended while it was set up to the matchmaker."""
+    if matchmaker.partner_of(user_id) is not None:
+        # Paired again meanwhile, that pairing sets the state
+        return
+    state = ChatState.searching if matchmaker.is_waiting(user_id) else ChatState.idle
+    await dp.current_state(chat=user_id, user=user_id).set_state(state.state)
+
+async def connect(user1, user2):
+    """Tell a new pair they are connected and start their chat."""
+    results = await asyncio.gather(
+        sender.send_message(user1, "💬 You're now connected! Say hi!", reply_markup=CHATTING_KEYBOARD),
+        sender.send_message(user2, "💬 You're now connected! Say hi!", reply_markup=CHATTING_KEYBOARD),
+        return_exceptions=True,
+    )
+    gone = []
+    for user_id, result in zip((user1, user2), results):
+        if isinstance(result, (BotBlocked, ChatNotFound, UserDeactivated)):
+            logger.warning(f"Failed to connect users {user1} and {user2}: {user_id}: {result}")
+            gone.append(user_id)
+        elif isinstance(result, Exception):
+            raise result
+
+    # Either user may have pressed /start or End Chat while the notices were sent
+    if matchmaker.partner_of(user1) != user2:
+        logger.info(f"Pair {user1} and {user2} ended while connecting")
+        for user_id in (user1, user2):
+            if user_id in gone:
+                await dp.current_state(chat=user_id, user=user_id).reset_state()
+            else:
+                await sync_state(user_id)
+        return
 
-    if user_id in active_pairs:
-        await message.answer("⚠️ You're already in a chat!", reply_markup=get_chatting_keyboard())
+    if gone:
+        matchmaker.unpair(user1)
+        for user_id in (user1, user2):
+            if user_id in gone:
+                await dp.current_state(chat=user_id, user=user_id).reset_state()
+            else:
+                await search_again(user_id)
         return
 
-    if user_id not in waiting_users:
-        waiting_users.append(user_id)
+    await dp.current_state(chat=user1, user=user1).set_state(ChatState.chatting.state)
+    await dp.current_state(chat=user2, user=user2).set_state(ChatState.chatting.state)
+    # The chat timeout runs from the moment the chat starts, not from the search
+    reaper.touch(user1)
+    reaper.touch(user2)
 
-    await ChatState.searching.set()
-    await message.answer("🔍 Searching for a partner...", reply_markup=get_searching_keyboard())
+async def search_again(user_id):
+    """Put a user whose new partner turned out unreachable back in the queue."""
+    pair = matchmaker.enqueue(user_id)
+    await dp.current_state(chat=user_id, user=user_id).set_state(ChatState.searching.state)
+    try:
+        await sender.send_message(user_id, "⚠️ Partner is unavailable, searching again...",
+                                  reply_markup=SEARCHING_KEYBOARD)
+    except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+        logger.warning(f"Failed to notify {user_id} of a new search: {e}")
+    if pair:
+        await connect(*pair)
 
-    if len(waiting_users) >= 2:
-        user1 = waiting_users.pop(0)
-        user2 = waiting_users.pop(0)
+@router.text("🚀 Start Chat", state=ChatState.idle)
+async def start_search(message: types.Message):
+    user_id = message.from_user.id
 
-        active_pairs[user1] = user2
-        active_pairs[user2] = user1
+    if matchmaker.partner_of(user_id):
+        await sender.answer(message, "⚠️ You're already in a chat!", reply_markup=CHATTING_KEYBOARD)
+        return
 
-        try:
-            await bot.send_message(user1, "💬 You're now connected! Say hi!", reply_markup=get_chatting_keyboard())
-            await bot.send_message(user2, "💬 You're now connected! Say hi!", reply_markup=get_chatting_keyboard())
-        except (BotBlocked, ChatNotFound, UserDeactivated) as e:
-            logger.warning(f"Failed to connect users {user1} and {user2}: {e}")
-            active_pairs.pop(user1, None)
-            active_pairs.pop(user2, None)
-            await ChatState.idle.set()
-            return
+    # Pairing happens before the first await so no other handler can claim the same partner
+    pair = matchmaker.enqueue(user_id)
 
-        await dp.current_state(chat=user1, user=user1).set_state(ChatState.chatting.state)
-        await dp.current_state(chat=user2, user=user2).set_state(ChatState.chatting.state)
+    await ChatState.searching.set()
+    await sender.answer(message, "🔍 Searching for a partner...", reply_markup=SEARCHING_KEYBOARD)
 
-@dp.message_handler(text="❌ Cancel Search", state=ChatState.searching)
+    if pair:
+        await connect(*pair)
+
+@router.text("❌ Cancel Search", state=ChatState.searching)
 async def cancel_search(message: types.Message):
     user_id = message.from_user.id
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
+    matchmaker.cancel(user_id)
 
     await ChatState.idle.set()
-    await message.answer("❌ Search canceled.", reply_markup=get_main_keyboard())
+    await sender.answer(message, "❌ Search canceled.", reply_markup=MAIN_KEYBOARD)
 
-@dp.message_handler(text="⏭️ Next Partner", state=ChatState.chatting)
+@router.text("⏭️ Next Partner", state=ChatState.chatting)
 async def next_partner(message: types.Message):
     user_id = message.from_user.id
-    partner_id = active_pairs.get(user_id)
+    partner_id = matchmaker.unpair(user_id)
 
     if partner_id:
-        active_pairs.pop(partner_id, None)
         try:
-            await bot.send_message(partner_id, "⚠️ Your partner left the chat.", reply_markup=get_main_keyboard())
+            await sender.send_message(partner_id, "⚠️ Your partner left the chat.", reply_markup=MAIN_KEYBOARD)
         except (BotBlocked, ChatNotFound, UserDeactivated) as e:
             logger.warning(f"Next Partner: {partner_id} error: {e}")
 
-    active_pairs.pop(user_id, None)
     await start_search(message)
 
-@dp.message_handler(text="⏹️ End Chat", state='*')
+@router.text("⏹️ End Chat")
 async def end_chat(message: types.Message):
     user_id = message.from_user.id
-    partner_id = active_pairs.get(user_id)
+    partner_id = matchmaker.discard(user_id)
 
     if partner_id:
-        active_pairs.pop(partner_id, None)
         try:
-            await bot.send_message(partner_id, "❌ Chat ended by partner.", reply_markup=get_main_keyboard())
+            await sender.send_message(partner_id, "❌ Chat ended by partner.", reply_markup=MAIN_KEYBOARD)
         except (BotBlocked, ChatNotFound, UserDeactivated) as e:
             logger.warning(f"End Chat: {partner_id} error: {e}")
 
-    active_pairs.pop(user_id, None)
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
-
     await ChatState.idle.set()
-    await message.answer("❌ Chat ended.", reply_markup=get_main_keyboard())
+    await sender.answer(message, "❌ Chat ended.", reply_markup=MAIN_KEYBOARD)
 
-@dp.message_handler(state=ChatState.chatting, content_types=types.ContentTypes.TEXT)
-async def forward_message(message: types.Message):
+async def relay(message: types.Message, method, count=1, **kwargs):
+    """Send `method` to the partner of the message's sender; `count` messages are relayed by it."""
     user_id = message.from_user.id
-    partner_id = active_pairs.get(user_id)
+    partner_id = matchmaker.partner_of(user_id)
 
     if not partner_id:
-        await message.answer("⚠️ No active partner found.", reply_markup=get_main_keyboard())
-        await ChatState.idle.set()
+        await sender.answer(message, "⚠️ No active partner found.", reply_markup=MAIN_KEYBOARD)
+        await dp.current_state(chat=user_id, user=user_id).set_state(ChatState.idle.state)
         return
 
     try:
-        await bot.send_message(partner_id, f"👤: {message.text}")
+        await sender.request(method, partner_id, priority=RELAY, **kwargs)
+        metrics.RELAYED.inc(amount=count)
+        matchmaker.relayed(user_id, partner_id)
     except (BotBlocked, ChatNotFound, UserDeactivated) as e:
         logger.warning(f"Message Forward Failed: {e}")
-        await message.answer("⚠️ Partner is unavailable. Ending chat.", reply_markup=get_main_keyboard())
+        await sender.answer(message, "⚠️ Partner is unavailable. Ending chat.", reply_markup=MAIN_KEYBOARD)
         await end_chat(message)
 
-@dp.message_handler(state=ChatState.chatting, content_types=types.ContentTypes.ANY)
-async def block_non_text_chatting(message: types.Message):
-    if message.content_type != 'text':
-        await message.reply("❌ Only text messages are allowed!", reply_markup=get_chatting_keyboard())
+@router.content(types.ContentType.TEXT, state=ChatState.chatting)
+async def forward_message(message: types.Message):
+    await relay(message, 'send_message', text=f"👤: {message.text}")
 
-@dp.message_handler(state=ChatState.searching, content_types=types.ContentTypes.ANY)
+# Media is copied by file_id: nothing is downloaded, and unlike a forward the copy does not name the sender
+async def relay_media(message: types.Message):
+    if message.media_group_id and message.content_type in ALBUM_MEDIA:
+        albums.add(message)
+        return
+    await relay(message, 'copy_message', from_chat_id=message.chat.id, message_id=message.message_id)
+
+async def relay_album(messages):
+    await relay(messages[0], 'send_media_group', count=len(messages), media=[input_media(m) for m in messages])
+
+albums = AlbumBuffer(relay_album, delay=config.ALBUM_DELAY)
+if config.RELAY_CONTENT_TYPES:
+    router.content(*config.RELAY_CONTENT_TYPES, state=ChatState.chatting)(relay_media)
+
+@router.content(state=ChatState.chatting)
+async def block_unsupported_chatting(message: types.Message):
+    await sender.reply(message, "❌ This type of message can't be sent to your partner.",
+                       reply_markup=CHATTING_KEYBOARD)
+
+@router.content(state=ChatState.searching)
 async def block_while_searching(message: types.Message):
-    await message.reply("⏳ Please wait while we find you a partner...", reply_markup=get_searching_keyboard())
+    await sender.reply(message, "⏳ Please wait while we find you a partner...", reply_markup=SEARCHING_KEYBOARD)
 
-@dp.message_handler(content_types=types.ContentTypes.ANY, state='*')
+@router.content()
 async def block_global_non_text(message: types.Message):
     if message.content_type != 'text':
-        await message.reply("❌ This bot only supports text messages.", reply_markup=get_main_keyboard())
+        await sender.reply(message, "💬 Start a chat to send messages to a partner.", reply_markup=MAIN_KEYBOARD)
+
+router.install()
+
+async def on_expire(kind, user_id, partner_id):
+    if kind == SEARCHING:
+        notices = [(user_id, "⌛ Search timed out.")]
+    else:
+        notices = [(partner_id, "⌛ Your partner timed out."), (user_id, "⌛ Chat closed for inactivity.")]
+
+    # The user who timed out has often blocked the bot, the partner is told first
+    for chat_id, text in notices:
+        if not chat_id:
+            continue
+        try:
+            await sender.send_message(chat_id, text, reply_markup=MAIN_KEYBOARD)
+        except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+            logger.warning(f"Failed to notify {chat_id} of a {kind} timeout: {e}")
+
+# Inactive users are expired by the reaper, which sees every message through the router
+# and every relay to a user through the matchmaker
+def create_reaper():
+    reaper = Reaper(matchmaker, dp.storage, search_timeout=config.SEARCH_TIMEOUT, chat_timeout=config.CHAT_TIMEOUT,
+                    idle_timeout=config.IDLE_TIMEOUT, on_expire=on_expire)
+    router.on_message = reaper.touch
+    matchmaker.on_relay = reaper.touch
+    return reaper
+
+reaper = create_reaper()
+
+async def start_metrics_server(port):
+    if port:
+        await metrics.start_server(config.METRICS_HOST, port)
+
+async def start_reaper(dp):
+    reaper.start()
+
+async def on_startup(dp):
+    await start_reaper(dp)
+    await start_metrics_server(config.METRICS_PORT)
+
+async def on_shutdown(dp):
+    await reaper.stop()
+    await albums.close()
+    await sender.close()
+
+# Sharded mode
+async def on_remote_pair(user_id, partner_id):
+    try:
+        await sender.send_message(user_id, "💬 You're now connected! Say hi!", reply_markup=CHATTING_KEYBOARD)
+    except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+        logger.warning(f"Failed to connect user {user_id} to {partner_id}: {e}")
+        matchmaker.unpair(user_id)
+        return
+
+    await dp.current_state(chat=user_id, user=user_id).set_state(ChatState.chatting.state)
+    reaper.touch(user_id)
+
+async def on_remote_unpair(user_id, partner_id):
+    # The partner's shard ended the chat, by End Chat, Next Partner or a timeout
+    await dp.current_state(chat=user_id, user=user_id).set_state(ChatState.idle.state)
+
+def init_shard(worker):
+    global sender, matchmaker, reaper
+
+    # Logging threads do not survive the fork
+    setup_logging(config.LOG_LEVEL, config.LOG_SAMPLE_RATE, config.LOG_FORMAT)
+
+    # Each worker gets its share of the global send rate and its own state file
+    sender = SendScheduler(bot, global_rate=config.SEND_GLOBAL_RATE / worker.workers, chat_rate=config.SEND_CHAT_RATE,
+                           chat_burst=config.SEND_CHAT_BURST, max_retries=config.SEND_MAX_RETRIES)
+    dp.storage = create_storage(config.STORAGE_BACKEND, shard_path(config.STORAGE_PATH, worker.index),
+                                config.STORAGE_FLUSH_INTERVAL, worker.workers)
+    matchmaker = RemoteMatchmaker(worker, on_pair=on_remote_pair, on_unpair=on_remote_unpair)
+    dp.storage.attach(matchmaker)
+    reaper = create_reaper()
+    worker.on_startup.append(start_reaper)
+    # Shard i exposes its metrics on METRICS_PORT + 1 + i
+    if config.METRICS_PORT:
+        worker.on_startup.append(lambda dp: start_metrics_server(config.METRICS_PORT + 1 + worker.index))
+    worker.on_shutdown.append(on_shutdown)
 
 if __name__ == '__main__':
-    print("✅ Bot is running...")
-    executor.start_polling(dp, skip_updates=True)
+    print(f"✅ Bot is running ({config.BOT_MODE}, {config.WORKERS} worker(s))...")
+    if config.WORKERS > 1:
+        broker = Broker(dp, config.WORKERS, on_worker_start=init_shard)
+        broker.start()
+        metrics.WAITING_USERS.fn = lambda: len(broker.queue)
+        metrics.SHARDS_DOWN.fn = lambda: broker.dead
+        # Pairs, sends and tracked users live in the shards, which serve their own metrics
+        metrics.ACTIVE_PAIRS.fn = metrics.SEND_QUEUE_DEPTH.fn = metrics.TRACKED_USERS.fn = None
+
+        async def on_broker_startup(dp):
+            broker.attach()
+            await start_metrics_server(config.METRICS_PORT)
+
+        if config.BOT_MODE == 'webhook':
+            run_webhook(dp, config.WEBHOOK_URL, path=config.WEBHOOK_PATH, secret=config.WEBHOOK_SECRET,
+                        host=config.WEBAPP_HOST, port=config.WEBAPP_PORT, stats=broker.stats,
+                        feed_update=broker.feed_update, on_startup=on_broker_startup, on_shutdown=broker.stop)
+        else:
+            broker.on_startup.append(lambda dp: start_metrics_server(config.METRICS_PORT))
+            broker.run_polling(skip_updates=True)
+    elif config.BOT_MODE == 'webhook':
+        run_webhook(dp, config.WEBHOOK_URL, path=config.WEBHOOK_PATH, secret=config.WEBHOOK_SECRET,
+                    host=config.WEBAPP_HOST, port=config.WEBAPP_PORT, stats=sender.stats,
+                    on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        # The executor only shuts down cleanly on Ctrl+C; a deploy's SIGTERM stops the loop the same
+        # way, so on_shutdown still drains the send queue and the storage gets its last flush
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
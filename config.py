@@ -4,3 +4,61 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+
+# Bot API endpoint, e.g. http://localhost:8081 for a local fake API (default: api.telegram.org)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# How updates are received: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+
+# Webhook mode
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = f"{WEBHOOK_HOST.rstrip('/')}{WEBHOOK_PATH}"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+
+# Outbound send limits (messages per second)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+
+# State storage: "memory" or "sqlite" (survives restarts)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory").lower()
+STORAGE_PATH = os.getenv("STORAGE_PATH", "chatbot.db")
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1.0"))
+
+# Number of shard worker processes; more than 1 starts the sharded mode
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+# Logging: level, fraction of records below WARNING to keep, "json" or "text"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# Prometheus metrics endpoint, off unless METRICS_PORT is set, in polling and webhook mode.
+# It has no authentication, keep it on a private interface; shard workers use METRICS_PORT + 1 + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Idle reaper: seconds without a message before a search is dropped, a chat is closed,
+# and an idle user's FSM state is evicted (0 disables each)
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "600"))
+CHAT_TIMEOUT = float(os.getenv("CHAT_TIMEOUT", "1800"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "3600"))
+
+# Message types relayed between partners by file_id with copyMessage; text is always relayed.
+# Location and contact are left out by default, they can reveal who the sender is.
+RELAY_CONTENT_TYPES = os.getenv(
+    "RELAY_CONTENT_TYPES", "photo,video,animation,sticker,voice,video_note,audio,document").replace(" ", "").lower()
+RELAY_CONTENT_TYPES = [t for t in RELAY_CONTENT_TYPES.split(",") if t and t != "text"]
+# Content types copyMessage can relay
+COPYABLE_CONTENT_TYPES = ("photo", "video", "animation", "sticker", "voice", "video_note", "audio", "document",
+                          "location", "venue", "contact", "poll", "dice")
+_unknown = sorted(set(RELAY_CONTENT_TYPES) - set(COPYABLE_CONTENT_TYPES))
+if _unknown:
+    raise ValueError(f"Unknown RELAY_CONTENT_TYPES: {', '.join(_unknown)}; supported: {', '.join(COPYABLE_CONTENT_TYPES)}")
+# Seconds to wait for the rest of an album before relaying it in one call
+ALBUM_DELAY = float(os.getenv("ALBUM_DELAY", "0.5"))
@@ -0,0 +1,97 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps every WARNING and above, and `rate` of the records below it."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, for the listener thread to format.
+
+    The stock prepare() formats the whole record on the calling thread and
+    pastes the traceback into the message. Here only the message is merged
+    with its args. The exception is kept apart, as `exc_type`, `exc_message`
+    and the traceback in `exc_text`: the traceback object would keep the
+    caller's frames alive while the record waits.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            exc_type, exc, _ = record.exc_info
+            record.exc_type = exc_type.__name__
+            record.exc_message = str(exc)
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            exc_type, exc, _ = record.exc_info
+            entry["exc"] = {"type": exc_type.__name__, "message": str(exc),
+                            "traceback": self.formatException(record.exc_info)}
+        elif record.exc_text:
+            entry["exc"] = {"type": getattr(record, 'exc_type', None), "message": getattr(record, 'exc_message', None),
+                            "traceback": record.exc_text}
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level="INFO", sample_rate=1.0, fmt="json"):
+    """Log through a queue so handlers never block on stderr.
+
+    Records are filtered and sampled before they are queued; a background
+    thread formats and writes them. Safe to call again after a fork.
+    """
+    global _listener
+    _stop_listener()
+
+    output = logging.StreamHandler()
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    if sample_rate < 1:
+        handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
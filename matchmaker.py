@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+
+from metrics import SEARCH_WAIT
+
+
+class Matchmaker:
+    """Search queue and partner pairs with O(1) enqueue, cancel and pairing.
+
+    Every method is synchronous, so a call can never interleave with another
+    handler running on the same event loop: pairing is atomic.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # Insertion-ordered set of searching users -> time they started searching
+        self._waiting = OrderedDict()
+        self._pairs = {}
+        # Called with a user id whenever that user's queue or pair state changes
+        self.on_change = None
+        # Called with a user id whenever their partner's message was relayed to them
+        self.on_relay = None
+
+    def __len__(self):
+        return len(self._waiting)
+
+    @property
+    def pair_count(self):
+        return len(self._pairs) // 2
+
+    def is_waiting(self, user_id):
+        return user_id in self._waiting
+
+    def waiting_since(self, user_id):
+        return self._waiting.get(user_id)
+
+    def partner_of(self, user_id):
+        return self._pairs.get(user_id)
+
+    def is_local(self, user_id):
+        """Whether the user's FSM record is kept by this process."""
+        return True
+
+    def restore(self, waiting, pairs):
+        """Load state saved by a storage backend, without reporting changes."""
+        now = self.clock()
+        for user_id in waiting:
+            self._waiting[user_id] = now
+        self._pairs.update(pairs)
+
+    def enqueue(self, user_id):
+        """Put `user_id` in the queue; return the new pair if one was formed."""
+        if user_id in self._pairs or user_id in self._waiting:
+            return None
+
+        if not self._waiting:
+            self._waiting[user_id] = self.clock()
+            self._changed(user_id)
+            return None
+
+        partner_id, since = self._waiting.popitem(last=False)
+        SEARCH_WAIT.observe(self.clock() - since)
+        self.link(partner_id, user_id)
+        return partner_id, user_id
+
+    def cancel(self, user_id):
+        if self._waiting.pop(user_id, None) is None:
+            return False
+        self._changed(user_id)
+        return True
+
+    def link(self, user1, user2):
+        self._waiting.pop(user1, None)
+        self._waiting.pop(user2, None)
+        self._pairs[user1] = user2
+        self._pairs[user2] = user1
+        self._changed(user1)
+        self._changed(user2)
+
+    def unpair(self, user_id):
+        """Break the pair `user_id` is in; return the former partner."""
+        partner_id = self._pairs.pop(user_id, None)
+        if partner_id is not None:
+            self._pairs.pop(partner_id, None)
+            self._changed(user_id)
+            self._changed(partner_id)
+        return partner_id
+
+    def relayed(self, user_id, partner_id):
+        """A message of `user_id` was relayed to `partner_id`: the chat is active for both."""
+        if self.on_relay is not None:
+            self.on_relay(partner_id)
+
+    def discard(self, user_id):
+        """Drop `user_id` from the queue and from any pair; return the former partner."""
+        self.cancel(user_id)
+        return self.unpair(user_id)
+
+    def _changed(self, user_id):
+        if self.on_change is not None:
+            self.on_change(user_id)
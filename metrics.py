@@ -0,0 +1,153 @@
+import bisect
+import time
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def _label_str(self, values, extra=None):
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *values, amount=1):
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def _samples(self):
+        for values, count in self._values.items():
+            yield f"{self.name}{self._label_str(values)} {count}"
+
+
+class Gauge(Metric):
+    """Gauge read from `fn()` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def _samples(self):
+        if self.fn is not None:
+            yield f"{self.name} {self.fn()}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *values):
+        series = self._values.get(values)
+        if series is None:
+            # Per-bucket counts followed by +Inf count and sum
+            series = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *values):
+        return _Timer(self, values)
+
+    def _samples(self):
+        for values, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._label_str(values, le)} {cumulative}"
+            yield f"{self.name}_sum{self._label_str(values)} {series[-1]}"
+            yield f"{self.name}_count{self._label_str(values)} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ('histogram', 'values', 'start')
+
+    def __init__(self, histogram, values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.values)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.add(Histogram(
+    "chatbot_handler_seconds", "Time spent in each message handler", labels=("handler",)))
+SEARCH_WAIT = REGISTRY.add(Histogram(
+    "chatbot_search_wait_seconds", "Time users spent in the search queue before pairing",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800)))
+ACTIVE_PAIRS = REGISTRY.add(Gauge("chatbot_active_pairs", "Chats in progress"))
+WAITING_USERS = REGISTRY.add(Gauge("chatbot_waiting_users", "Users in the search queue"))
+RELAYED = REGISTRY.add(Counter("chatbot_relayed_messages_total", "Messages relayed between partners"))
+SEND_QUEUE_DEPTH = REGISTRY.add(Gauge("chatbot_send_queue_depth", "Bot API calls waiting in the send queue"))
+SEND_LATENCY = REGISTRY.add(Histogram(
+    "chatbot_send_seconds", "Time from queueing a Bot API call to its response", labels=("method",)))
+API_ERRORS = REGISTRY.add(Counter(
+    "chatbot_bot_api_errors_total", "Failed Bot API calls by exception type", labels=("method", "error")))
+RECLAIMED = REGISTRY.add(Counter(
+    "chatbot_reclaimed_users_total", "Inactive users dropped by the reaper, by state", labels=("kind",)))
+TRACKED_USERS = REGISTRY.add(Gauge("chatbot_tracked_users", "Users the reaper is tracking for inactivity"))
+SHARDS_DOWN = REGISTRY.add(Gauge("chatbot_shards_down", "Shard workers that exited"))
+
+
+async def handle_metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def add_routes(app, path="/metrics"):
+    app.router.add_get(path, handle_metrics)
+
+
+async def start_server(host, port, path="/metrics"):
+    app = web.Application()
+    add_routes(app, path)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
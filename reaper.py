@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import math
+import time
+
+from metrics import RECLAIMED
+
+logger = logging.getLogger(__name__)
+
+SEARCHING = 'search'
+CHATTING = 'chat'
+IDLE = 'idle'
+
+
+class TimerWheel:
+    """Hashed timing wheel of keys and the tick they are due at.
+
+    `slots` buckets of `tick` seconds each. A key due further out than one
+    turn of the wheel waits in its bucket for the remaining turns.
+    Scheduling and cancelling are O(1); `advance` only visits the buckets
+    whose ticks have passed.
+    """
+
+    def __init__(self, tick=1.0, slots=4096, now=0.0):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        # key -> tick it is due at, the bucket is that tick modulo the wheel size
+        self._due = {}
+        self._current = int(now // tick)
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def due(self, key):
+        """Time at which `key` fires, or None."""
+        tick = self._due.get(key)
+        return None if tick is None else tick * self.tick
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        # Keys already overdue fire on the next tick
+        tick = max(math.ceil(deadline / self.tick), self._current + 1)
+        self._due[key] = tick
+        self._slots[tick % len(self._slots)][key] = tick
+
+    def cancel(self, key):
+        tick = self._due.pop(key, None)
+        if tick is not None:
+            del self._slots[tick % len(self._slots)][key]
+
+    def advance(self, now):
+        """Move the wheel to `now`; return the keys that came due."""
+        target = int(now // self.tick)
+        expired = []
+        steps = min(target - self._current, len(self._slots))
+        for tick in range(self._current + 1, self._current + 1 + steps):
+            slot = self._slots[tick % len(self._slots)]
+            due = [key for key, key_tick in slot.items() if key_tick <= target]
+            for key in due:
+                del slot[key]
+                del self._due[key]
+            expired.extend(due)
+        self._current = max(self._current, target)
+        return expired
+
+
+class Reaper:
+    """Drops users who went quiet, so state does not grow with every visitor.
+
+    A user silent for `search_timeout` while in the queue loses their place,
+    one silent for `chat_timeout` in a chat loses the chat, and any other
+    user silent for `idle_timeout` has their FSM record evicted. A timeout
+    of 0 disables that kind of expiry.
+
+    `touch` only records the time of the user's last message. A user's wheel
+    entry is checked when it fires: if they were active since, or their
+    timeout is longer than it was scheduled for, it is put back on the wheel
+    for the real deadline. A message relayed to a user in a chat counts as
+    their activity too (the matchmaker reports it, see `Matchmaker.relayed`),
+    so a chat only times out once both sides went quiet. Expired users are
+    evicted from storage in one batch per tick, a partner left behind has
+    their FSM state reset to the default, and `on_expire(kind, user_id,
+    partner_id)` is started for each of them to notify users.
+    """
+
+    def __init__(self, matchmaker, storage, search_timeout=600, chat_timeout=1800, idle_timeout=3600,
+                 on_expire=None, tick=1.0, clock=time.monotonic):
+        self.matchmaker = matchmaker
+        self.storage = storage
+        self.timeouts = {SEARCHING: search_timeout, CHATTING: chat_timeout, IDLE: idle_timeout}
+        self.on_expire = on_expire
+        self.clock = clock
+        self.wheel = TimerWheel(tick, now=clock())
+        # Shortest enabled timeout, what a user is first scheduled for
+        self._shortest = min((t for t in self.timeouts.values() if t), default=0)
+        self._seen = {}
+        self._runner = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._seen)
+
+    @property
+    def enabled(self):
+        return self._shortest > 0
+
+    def touch(self, user_id):
+        if not self._shortest:
+            return
+        now = self.clock()
+        self._seen[user_id] = now
+        due = self.wheel.due(user_id)
+        # The user may have just entered a state with a shorter timeout
+        if due is None or now + self._shortest < due:
+            self.wheel.schedule(user_id, now + self._shortest)
+
+    def track(self, user_ids):
+        """Start the clock for users restored from storage."""
+        for user_id in user_ids:
+            if user_id not in self._seen:
+                self.touch(user_id)
+
+    def kind_of(self, user_id):
+        if self.matchmaker.partner_of(user_id) is not None:
+            return CHATTING
+        if self.matchmaker.is_waiting(user_id):
+            return SEARCHING
+        return IDLE
+
+    def expire(self):
+        """Advance the wheel and drop expired users from the queue and their chats.
+
+        Returns (kind, user_id, partner_id) for each expired user. A partner
+        left alone is idle from then on, so their own entry is not expired
+        with the chat if it comes due in the same sweep.
+        """
+        now = self.clock()
+        expired = []
+        for user_id in self.wheel.advance(now):
+            seen = self._seen.get(user_id)
+            if seen is None:
+                continue
+            kind = self.kind_of(user_id)
+            timeout = self.timeouts[kind]
+            if not timeout:
+                # Expiry is off in this state, look again once it could have changed
+                self.wheel.schedule(user_id, now + self._shortest)
+            elif seen + timeout > now:
+                self.wheel.schedule(user_id, seen + timeout)
+            else:
+                del self._seen[user_id]
+                partner_id = None
+                if kind == SEARCHING:
+                    self.matchmaker.cancel(user_id)
+                elif kind == CHATTING:
+                    partner_id = self.matchmaker.unpair(user_id)
+                expired.append((kind, user_id, partner_id))
+        return expired
+
+    async def reap(self):
+        expired = self.expire()
+        for kind, user_id, partner_id in expired:
+            RECLAIMED.inc(kind)
+            if self.on_expire is not None and kind != IDLE:
+                self._spawn(self.on_expire(kind, user_id, partner_id))
+        # Their FSM records go in one batch, one write-behind flush for SQLite
+        for kind, user_id, partner_id in expired:
+            await self.storage.reset_state(chat=user_id, user=user_id)
+            # A partner kept by another shard is reset there when it hears of the unpair
+            if partner_id is not None and self.matchmaker.is_local(partner_id):
+                await self.storage.reset_state(chat=partner_id, user=partner_id, with_data=False)
+        if expired:
+            logger.info(f"Reaped {len(expired)} users, tracking {len(self._seen)}")
+        return expired
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def start(self):
+        if self.enabled and self._runner is None:
+            self.track(self.storage.users())
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            try:
+                await self.reap()
+            except Exception:
+                logger.exception("Reaper sweep failed")
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
@@ -0,0 +1,78 @@
+from aiogram import types
+
+from metrics import HANDLER_LATENCY
+
+ANY_STATE = '*'
+ANY_CONTENT = 'any'
+
+
+class Router:
+    """Dispatches messages through lookup tables instead of aiogram's filter chain.
+
+    Button texts and commands are keyed by (state, text), everything else by
+    (state, content type). A message costs one state read and at most six
+    dict lookups, however many handlers are registered. Lookup order:
+    text routes for the current state, then for any state; then content
+    routes for (state, type), (state, any), (any state, type) and
+    (any state, any).
+
+    Users without a state (new, or evicted by the reaper) are routed as if
+    they were in `default_state`. `on_message(user_id)` is called for every
+    message before it is routed.
+    """
+
+    def __init__(self, dp, default_state=ANY_STATE):
+        self.dp = dp
+        self.default_state = _state_name(default_state)
+        self.on_message = None
+        self._texts = {}
+        self._contents = {}
+
+    def text(self, *texts, state=ANY_STATE):
+        """Route button texts or commands ("/start") to the handler."""
+        def decorator(handler):
+            for text in texts:
+                self._texts[(_state_name(state), text)] = handler
+            return handler
+        return decorator
+
+    def content(self, *content_types, state=ANY_STATE):
+        def decorator(handler):
+            for content_type in content_types or (ANY_CONTENT,):
+                self._contents[(_state_name(state), content_type)] = handler
+            return handler
+        return decorator
+
+    def resolve(self, state, message):
+        state = state or self.default_state
+        content_type = message.content_type
+        if content_type == types.ContentType.TEXT:
+            text = message.text
+            if text.startswith('/'):
+                # "/start@bot payload" -> "/start"
+                text = text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+            handler = self._texts.get((state, text)) or self._texts.get((ANY_STATE, text))
+            if handler:
+                return handler
+
+        contents = self._contents
+        return (contents.get((state, content_type)) or contents.get((state, ANY_CONTENT))
+                or contents.get((ANY_STATE, content_type)) or contents.get((ANY_STATE, ANY_CONTENT)))
+
+    async def dispatch(self, message: types.Message):
+        user_id = message.from_user.id
+        if self.on_message is not None:
+            self.on_message(user_id)
+        state = await self.dp.storage.get_state(chat=message.chat.id, user=user_id)
+        handler = self.resolve(state, message)
+        if handler is not None:
+            with HANDLER_LATENCY.time(handler.__name__):
+                await handler(message)
+
+    def install(self):
+        """Register the router as the single message handler of the dispatcher."""
+        self.dp.register_message_handler(self.dispatch, state=ANY_STATE, content_types=types.ContentTypes.ANY)
+
+
+def _state_name(state):
+    return getattr(state, 'state', state)
@@ -0,0 +1,254 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import API_ERRORS, SEND_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# Send priorities, lower goes first
+RELAY = 0
+REPLY = 1
+
+PRUNE_INTERVAL = 60
+# Chats flood limited at the same time that mean the bot-wide limit was hit
+GLOBAL_FLOOD_CHATS = 3
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """Hold back the next token for at least `seconds`."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('method', 'kwargs', 'priority', 'seq', 'created', 'attempts', 'future')
+
+    def __init__(self, method, kwargs, priority, seq):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _ChatQueue:
+    __slots__ = ('jobs', 'bucket', 'scheduled', 'busy')
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.scheduled = False
+        self.busy = False
+
+
+class SendScheduler:
+    """Central outbound queue for Bot API calls.
+
+    Calls are rate limited by a global token bucket and one bucket per chat.
+    Each chat has at most one request in flight, so its messages arrive in
+    order, while different chats are sent concurrently. Chat relays go ahead
+    of menu replies. `RetryAfter` pauses the affected chat for the requested
+    time and retries; every other error is raised to the caller.
+
+    Telegram does not say which limit a `RetryAfter` is for. One chat at a
+    time is taken as that chat's limit, but once GLOBAL_FLOOD_CHATS chats are
+    paused at the same time the bot-wide limit was hit, and all sends pause.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []  # heap of (priority, seq, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._inflight = set()
+        # chat_id -> when its flood pause ends
+        self._flooded = {}
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+
+        self.pending = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1024)
+
+    async def request(self, method, chat_id, *, priority=REPLY, **kwargs):
+        """Queue `bot.<method>(chat_id=chat_id, **kwargs)` and wait for its result."""
+        job = _Job(method, dict(kwargs, chat_id=chat_id), priority, next(self._seq))
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.jobs.append(job)
+        self.pending += 1
+
+        if not chat.scheduled and not chat.busy:
+            self._push(chat_id)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        return await job.future
+
+    def send_message(self, chat_id, text, *, priority=REPLY, **kwargs):
+        return self.request('send_message', chat_id, priority=priority, text=text, **kwargs)
+
+    def answer(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, **kwargs)
+
+    def reply(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": self.pending,
+            "in_flight": len(self._inflight),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+    async def close(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while (self.pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def _push(self, chat_id):
+        chat = self._chats[chat_id]
+        chat.scheduled = True
+        head = chat.jobs[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _defer(self, chat_id, delay):
+        self._chats[chat_id].scheduled = True
+        asyncio.get_running_loop().call_later(delay, self._push, chat_id)
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            wait = chat.bucket.delay(now)
+            if wait > 0:
+                self._defer(chat_id, wait)
+                continue
+
+            job = chat.jobs.popleft()
+            self.pending -= 1
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.scheduled = False
+            chat.busy = True
+
+            task = asyncio.create_task(self._deliver(chat_id, chat, job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+            if now >= self._next_prune:
+                self._prune(now)
+
+    async def _deliver(self, chat_id, chat, job):
+        try:
+            result = await getattr(self.bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            API_ERRORS.inc(job.method, type(e).__name__)
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self._fail(job, e)
+            else:
+                logger.warning(f"Flood limit for chat {chat_id}, retrying in {e.timeout}s")
+                self.retried += 1
+                chat.jobs.appendleft(job)
+                self.pending += 1
+                chat.busy = False
+                self._defer(chat_id, e.timeout)
+                self._flood(chat_id, e.timeout)
+                return
+        except Exception as e:
+            API_ERRORS.inc(job.method, type(e).__name__)
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            latency = time.monotonic() - job.created
+            self._latencies.append(latency)
+            SEND_LATENCY.observe(latency, job.method)
+            if not job.future.done():
+                job.future.set_result(result)
+
+        chat.busy = False
+        if chat.jobs:
+            self._push(chat_id)
+
+    def _flood(self, chat_id, timeout):
+        now = time.monotonic()
+        self._flooded[chat_id] = now + timeout
+        self._flooded = {chat_id: until for chat_id, until in self._flooded.items() if until > now}
+        if len(self._flooded) >= GLOBAL_FLOOD_CHATS:
+            logger.warning(f"Flood limit for {len(self._flooded)} chats at once, pausing all sends for {timeout}s")
+            self._global.pause(now, timeout)
+            self._flooded.clear()
+
+    def _fail(self, job, error):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def _prune(self, now):
+        self._next_prune = now + PRUNE_INTERVAL
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.jobs and not chat.busy and not chat.scheduled and chat.bucket.is_full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
@@ -0,0 +1,438 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import signal
+
+from aiogram import Bot, Dispatcher
+
+from matchmaker import Matchmaker
+from webhook import process_update
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the user who sent them
+USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'my_chat_member', 'chat_member')
+
+
+# Seconds between the activity reports a shard sends for a partner on another shard
+ACTIVITY_INTERVAL = 10.0
+
+
+def shard_of(user_id, workers):
+    return user_id % workers
+
+
+def user_of(update):
+    for field in USER_FIELDS:
+        if field in update:
+            return update[field].get('from', {}).get('id', 0)
+    return 0
+
+
+class RemoteMatchmaker(Matchmaker):
+    """Matchmaker for one shard: pairing is done by the broker.
+
+    The shard keeps a local copy of the queue and pair state of its own users,
+    so `partner_of` on the relay hot path never leaves the process. `enqueue`
+    never pairs locally. The broker offers a pair with a "paired" event to
+    both users' shards; each shard accepts it if its user is still waiting,
+    or rejects it if they cancelled meanwhile. Only once both sides accepted
+    does the broker send "linked", and the users are linked and told. An
+    accepted offer can no longer be cancelled.
+
+    When a chat is broken from the other shard, `on_unpair(user_id, partner_id)`
+    is started for the user left on this one. Relays to a partner on another
+    shard are reported there, at most every ACTIVITY_INTERVAL seconds per
+    partner, so their chat does not time out while they only read.
+    """
+
+    def __init__(self, worker, on_pair, on_unpair=None):
+        super().__init__()
+        self.worker = worker
+        self.on_pair = on_pair
+        self.on_unpair = on_unpair
+        # user -> (partner, offer id) of a pair accepted but not yet confirmed by the broker
+        self._offers = {}
+        # Partner on another shard -> when their shard was last told of a relay to them
+        self._reported = {}
+        worker.matchmaker = self
+
+    def is_local(self, user_id):
+        return shard_of(user_id, self.worker.workers) == self.worker.index
+
+    def restore(self, waiting, pairs):
+        super().restore(waiting, pairs)
+        for user_id in waiting:
+            self.worker.send(('enqueue', user_id))
+
+    def enqueue(self, user_id):
+        if self.partner_of(user_id) is None and not self.is_waiting(user_id):
+            self._waiting[user_id] = self.clock()
+            self._changed(user_id)
+            self.worker.send(('enqueue', user_id))
+        return None
+
+    def cancel(self, user_id):
+        if user_id in self._offers or not super().cancel(user_id):
+            return False
+        self.worker.send(('cancel', user_id))
+        return True
+
+    def unpair(self, user_id):
+        partner_id = super().unpair(user_id)
+        if partner_id is not None:
+            self._reported.pop(partner_id, None)
+            self.worker.send(('unpair', user_id, partner_id))
+        return partner_id
+
+    def relayed(self, user_id, partner_id):
+        if self.is_local(partner_id):
+            super().relayed(user_id, partner_id)
+            return
+        now = self.clock()
+        if now - self._reported.get(partner_id, now - ACTIVITY_INTERVAL) >= ACTIVITY_INTERVAL:
+            self._reported[partner_id] = now
+            self.worker.send(('relayed', user_id, partner_id))
+
+    def apply(self, event):
+        kind = event[0]
+        if kind == 'paired':
+            _, user_id, partner_id, offer = event
+            if self.is_waiting(user_id):
+                self._offers[user_id] = (partner_id, offer)
+                self.worker.send(('accept', user_id, partner_id, offer))
+            else:
+                # The user cancelled while the broker was pairing them
+                self.worker.send(('reject', user_id, partner_id, offer))
+        elif kind == 'linked':
+            _, user_id, partner_id, offer = event
+            if self._offers.get(user_id) != (partner_id, offer):
+                return
+            del self._offers[user_id]
+            # Both users may live on this shard, then the first event already linked them
+            if self.partner_of(user_id) != partner_id:
+                self.link(user_id, partner_id)
+            self.worker.spawn(self.on_pair(user_id, partner_id))
+        elif kind == 'rejected':
+            # The partner cancelled, or the offer was stale; the user is still waiting
+            _, user_id, partner_id, offer = event
+            if self._offers.get(user_id) == (partner_id, offer):
+                del self._offers[user_id]
+        elif kind == 'relayed':
+            super().relayed(event[1], event[2])
+        elif kind == 'unpaired':
+            user_id = event[1]
+            partner_id = super().unpair(user_id)
+            if partner_id is not None:
+                self._reported.pop(partner_id, None)
+                if self.on_unpair is not None:
+                    self.worker.spawn(self.on_unpair(user_id, partner_id))
+
+
+class Worker:
+    """One shard process: handles updates of users with `user_id % workers == index`."""
+
+    def __init__(self, dp, index, workers, conn):
+        self.dp = dp
+        self.index = index
+        self.workers = workers
+        self.matchmaker = None
+        self.on_startup = []
+        self.on_shutdown = []
+        self._conn = conn
+        self._tasks = set()
+        self._stopped = None
+
+    def send(self, message):
+        self._conn.send(message)
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stopped = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, self._stop)
+
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        loop.add_reader(self._conn.fileno(), self._on_readable)
+        try:
+            for callback in self.on_startup:
+                loop.run_until_complete(callback(self.dp))
+            loop.run_until_complete(self._stopped)
+            loop.run_until_complete(self._shutdown())
+        finally:
+            loop.close()
+
+    def _stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def _on_readable(self):
+        try:
+            while self._conn.poll():
+                self._handle(self._conn.recv())
+        except EOFError:
+            # Broker is gone
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            self._stop()
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == 'update':
+            self.spawn(process_update(self.dp, message[1]))
+        elif kind in ('paired', 'linked', 'rejected', 'relayed', 'unpaired'):
+            self.matchmaker.apply(message)
+        elif kind == 'drain':
+            self.spawn(self._drain())
+        elif kind == 'stop':
+            self._stop()
+
+    async def _wait_idle(self):
+        current = asyncio.current_task()
+        while self._tasks - {current}:
+            await asyncio.wait(self._tasks - {current})
+
+    async def _drain(self):
+        await self._wait_idle()
+        self.send(('drained', self.index))
+
+    async def _shutdown(self):
+        await self._wait_idle()
+        for callback in self.on_shutdown:
+            await callback(self.dp)
+        await self.dp.storage.close()
+        await self.dp.storage.wait_closed()
+        session = await self.dp.bot.get_session()
+        await session.close()
+
+
+def _run_worker(dp, index, workers, conn, on_worker_start):
+    worker = Worker(dp, index, workers, conn)
+    if on_worker_start is not None:
+        on_worker_start(worker)
+    worker.run()
+
+
+class Broker:
+    """Parent process: routes updates to shard workers and pairs users across shards.
+
+    Workers are forked, so they inherit the handlers registered on `dp`.
+    `on_worker_start(worker)` runs in each child before it takes updates and
+    must install a `RemoteMatchmaker`. Bot API calls, relays included, are
+    made directly by the worker that handles the update; the broker only
+    forwards queue and pair events.
+
+    A worker that dies is not restarted: it was forked from the broker
+    before its event loop started. Updates of its users are dropped and
+    counted, and `stats()` reports the shard as dead, so the process
+    supervisor can restart the bot.
+    """
+
+    def __init__(self, dp, workers, on_worker_start=None):
+        self.dp = dp
+        self.workers = workers
+        self.on_worker_start = on_worker_start
+        self.queue = Matchmaker()
+        # Offered pairs, user -> (partner, offer id), until both shards accepted or one rejected
+        self._pending = {}
+        self._accepted = set()
+        self._offer_ids = itertools.count(1)
+        self.on_startup = []
+        self._conns = []
+        self._processes = []
+        self._dead = set()
+        self._drained = None
+        self.dropped = 0
+
+    def start(self):
+        """Fork the workers; call before the broker's event loop starts."""
+        ctx = multiprocessing.get_context('fork')
+        for index in range(self.workers):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_run_worker, name=f"shard-{index}", daemon=True,
+                                  args=(self.dp, index, self.workers, child_conn, self.on_worker_start))
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+        logger.info(f"Started {self.workers} shard workers")
+
+    def attach(self):
+        """Start reading worker events on the running event loop."""
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(self._conns):
+            loop.add_reader(conn.fileno(), self._on_readable, index, conn)
+
+    def feed(self, update):
+        if not self._send(shard_of(user_of(update), self.workers), ('update', update)):
+            self.dropped += 1
+
+    async def feed_update(self, update):
+        self.feed(update)
+
+    @property
+    def dead(self):
+        return len(self._dead)
+
+    def stats(self):
+        stats = {"workers": self.workers, "waiting": len(self.queue),
+                 "dead_shards": sorted(self._dead), "dropped_updates": self.dropped}
+        if self._dead:
+            stats["status"] = "degraded"
+        return stats
+
+    async def drain(self):
+        """Wait until every live worker has finished the updates fed so far."""
+        self._drained = set()
+        for index in range(self.workers):
+            self._send(index, ('drain',))
+        while len(self._drained | self._dead) < self.workers:
+            await asyncio.sleep(0.01)
+
+    async def stop(self, dp=None):
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(self._conns):
+            loop.remove_reader(conn.fileno())
+            self._send(index, ('stop',))
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, 30)
+        for conn in self._conns:
+            conn.close()
+
+    def _on_readable(self, index, conn):
+        try:
+            while conn.poll():
+                self._handle(index, conn.recv())
+        except EOFError:
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+            self._shard_died(index)
+
+    def _send(self, index, message):
+        if index in self._dead:
+            return False
+        try:
+            self._conns[index].send(message)
+        except OSError:
+            self._shard_died(index)
+            return False
+        return True
+
+    def _send_to_user(self, user_id, message):
+        self._send(shard_of(user_id, self.workers), message)
+
+    def _shard_died(self, index):
+        if index in self._dead:
+            return
+        self._dead.add(index)
+        logger.error(f"Shard {index} exited, updates of its users are dropped until the bot is restarted")
+        # Its users can no longer answer offers or be paired
+        for user_id in list(self.queue._waiting):
+            if shard_of(user_id, self.workers) == index:
+                self.queue.cancel(user_id)
+        for user_id in list(self._pending):
+            if shard_of(user_id, self.workers) == index and user_id in self._pending:
+                self._reject(user_id)
+
+    def _enqueue(self, user_id):
+        pair = self.queue.enqueue(user_id)
+        if pair:
+            user1, user2 = pair
+            # Pairs are tracked by the shards, the broker only keeps the queue and the offers
+            self.queue.unpair(user1)
+            offer = next(self._offer_ids)
+            self._pending[user1] = (user2, offer)
+            self._pending[user2] = (user1, offer)
+            self._send_to_user(user1, ('paired', user1, user2, offer))
+            self._send_to_user(user2, ('paired', user2, user1, offer))
+
+    def _accept(self, user_id, partner_id, offer):
+        self._accepted.add(user_id)
+        if partner_id in self._accepted:
+            for user, partner in ((user_id, partner_id), (partner_id, user_id)):
+                del self._pending[user]
+                self._accepted.discard(user)
+                self._send_to_user(user, ('linked', user, partner, offer))
+
+    def _reject(self, user_id):
+        partner_id, offer = self._pending.pop(user_id)
+        del self._pending[partner_id]
+        self._accepted.discard(user_id)
+        self._accepted.discard(partner_id)
+        self._send_to_user(partner_id, ('rejected', partner_id, user_id, offer))
+        # The queue never holds more than one user, so the partner is at its
+        # front again: paired with whoever is waiting, or with the next searcher
+        if shard_of(partner_id, self.workers) not in self._dead:
+            self._enqueue(partner_id)
+
+    def _handle(self, index, message):
+        kind = message[0]
+        if kind == 'enqueue':
+            self._enqueue(message[1])
+        elif kind == 'cancel':
+            user_id = message[1]
+            if not self.queue.cancel(user_id) and user_id in self._pending:
+                self._reject(user_id)
+        elif kind == 'accept':
+            _, user_id, partner_id, offer = message
+            if self._pending.get(user_id) == (partner_id, offer):
+                self._accept(user_id, partner_id, offer)
+            else:
+                # The offer was rejected by the other side meanwhile, release the user
+                self._send_to_user(user_id, ('rejected', user_id, partner_id, offer))
+        elif kind == 'reject':
+            _, user_id, partner_id, offer = message
+            if self._pending.get(user_id) == (partner_id, offer):
+                self._reject(user_id)
+        elif kind == 'unpair':
+            _, user_id, partner_id = message
+            if shard_of(partner_id, self.workers) != index:
+                self._send_to_user(partner_id, ('unpaired', partner_id))
+        elif kind == 'relayed':
+            self._send_to_user(message[2], message)
+        elif kind == 'drained':
+            self._drained.add(message[1])
+
+    async def _poll(self, skip_updates):
+        self.attach()
+        loop = asyncio.get_running_loop()
+        stopping = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: stopping.done() or stopping.set_result(None))
+
+        for callback in self.on_startup:
+            await callback(self.dp)
+
+        bot = self.dp.bot
+        if skip_updates:
+            await self.dp.skip_updates()
+
+        offset = None
+        while not stopping.done():
+            get_updates = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=20))
+            await asyncio.wait([get_updates, stopping], return_when=asyncio.FIRST_COMPLETED)
+            if not get_updates.done():
+                get_updates.cancel()
+                break
+            try:
+                updates = get_updates.result()
+            except Exception:
+                logger.exception("Failed to get updates")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.feed(update.to_python())
+
+        await self.stop()
+        session = await bot.get_session()
+        await session.close()
+
+    def run_polling(self, skip_updates=True):
+        asyncio.run(self._poll(skip_updates))
@@ -0,0 +1,273 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage as _MemoryStorage
+
+from shards import shard_of
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS fsm ("
+    "chat TEXT, user TEXT, state TEXT, data TEXT, bucket TEXT, PRIMARY KEY (chat, user))",
+    "CREATE TABLE IF NOT EXISTS matches (user_id INTEGER PRIMARY KEY, partner_id INTEGER)",
+    # The number of workers the file was written with, users are split between them by id
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+)
+
+
+class MemoryStorage(_MemoryStorage):
+    """FSM states and matchmaking state kept in process memory only."""
+
+    def attach(self, matchmaker):
+        pass
+
+    def users(self):
+        """Ids of the users that have an FSM record."""
+        return {int(user) for records in self.data.values() for user in records}
+
+
+class SQLiteStorage(MemoryStorage):
+    """In-memory storage with an SQLite write-behind copy that survives restarts.
+
+    Reads never touch the database. Writes mark the record dirty and a
+    background task flushes all dirty records in one transaction every
+    `flush_interval` seconds, off the event loop. On start the whole database
+    is loaded back into memory in one pass. The file records `workers`, the
+    shard layout it belongs to, for `rebalance`.
+    """
+
+    def __init__(self, path, flush_interval=1.0, workers=1):
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # A single writer thread keeps flushes ordered and off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('workers', ?)", (str(workers),))
+        self._db.commit()
+
+        self._dirty_records = set()
+        self._dirty_users = set()
+        self._matchmaker = None
+        self._flusher = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        for chat, user, state, data, bucket in self._db.execute("SELECT chat, user, state, data, bucket FROM fsm"):
+            self.data.setdefault(chat, {})[user] = {
+                'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket),
+            }
+        rows = self._db.execute("SELECT user_id, partner_id FROM matches ORDER BY rowid").fetchall()
+        self._waiting = [user_id for user_id, partner_id in rows if partner_id is None]
+        self._pairs = {user_id: partner_id for user_id, partner_id in rows if partner_id is not None}
+        logger.info(f"Loaded {sum(map(len, self.data.values()))} FSM records and "
+                    f"{len(self._pairs) // 2} pairs from {self.path}")
+
+    def attach(self, matchmaker):
+        matchmaker.restore(self._waiting, self._pairs)
+        self._waiting = self._pairs = None
+        self._matchmaker = matchmaker
+        matchmaker.on_change = self._mark_user
+
+    # Write-behind tracking
+
+    def _mark_record(self, chat, user):
+        self._dirty_records.add(tuple(map(str, self.check_address(chat=chat, user=user))))
+        self._start_flusher()
+
+    def _mark_user(self, user_id):
+        self._dirty_users.add(user_id)
+        self._start_flusher()
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"Failed to flush state to {self.path}")
+
+    async def flush(self):
+        if not self._dirty_records and not self._dirty_users:
+            return
+
+        records, self._dirty_records = self._dirty_records, set()
+        users, self._dirty_users = self._dirty_users, set()
+
+        upserts, deletes = [], []
+        for chat, user in records:
+            record = self.data.get(chat, {}).get(user)
+            if record is None:
+                deletes.append((chat, user))
+                continue
+            try:
+                upserts.append((chat, user, record['state'], json.dumps(record['data']), json.dumps(record['bucket'])))
+            except (TypeError, ValueError):
+                # Retrying would not help, the record stays in memory only
+                logger.exception(f"Failed to serialize FSM record of {chat}/{user}")
+
+        matches, unmatched = [], []
+        for user_id in users:
+            partner_id = self._matchmaker.partner_of(user_id)
+            if partner_id is not None or self._matchmaker.is_waiting(user_id):
+                matches.append((user_id, partner_id))
+            else:
+                unmatched.append((user_id,))
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, upserts, deletes, matches, unmatched)
+        except sqlite3.Error:
+            # The transaction was rolled back, write these again with the next flush
+            self._dirty_records |= records
+            self._dirty_users |= users
+            raise
+
+    def _write(self, upserts, deletes, matches, unmatched):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?)", upserts)
+            self._db.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deletes)
+            self._db.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?)", matches)
+            self._db.executemany("DELETE FROM matches WHERE user_id = ?", unmatched)
+
+    # BaseStorage
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super().set_state(chat=chat, user=user, state=state)
+        self._mark_record(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await super().set_data(chat=chat, user=user, data=data)
+        self._mark_record(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        self._mark_record(chat, user)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        await super().reset_state(chat=chat, user=user, with_data=with_data)
+        self._mark_record(chat, user)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await super().set_bucket(chat=chat, user=user, bucket=bucket)
+        self._mark_record(chat, user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await super().update_bucket(chat=chat, user=user, bucket=bucket, **kwargs)
+        self._mark_record(chat, user)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await super().close()
+
+    async def wait_closed(self):
+        self._executor.shutdown()
+        self._db.close()
+
+
+def create_storage(backend="memory", path="chatbot.db", flush_interval=1.0, workers=1):
+    if backend == "sqlite":
+        return SQLiteStorage(path, flush_interval, workers)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def shard_path(path, index):
+    """chatbot.db -> chatbot-<index>.db, one state file per shard worker."""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index}{ext}"
+
+
+def state_files(path, workers):
+    return [path] if workers == 1 else [shard_path(path, index) for index in range(workers)]
+
+
+def _read_state(file):
+    """Worker count a state file was written with (None for older files) and its rows."""
+    with sqlite3.connect(file) as db:
+        tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        row = db.execute("SELECT value FROM meta WHERE key = 'workers'").fetchone() if 'meta' in tables else None
+        fsm = db.execute("SELECT chat, user, state, data, bucket FROM fsm").fetchall() if 'fsm' in tables else []
+        matches = (db.execute("SELECT user_id, partner_id FROM matches ORDER BY rowid").fetchall()
+                   if 'matches' in tables else [])
+    db.close()
+    return int(row[0]) if row else None, fsm, matches
+
+
+def rebalance(path, workers):
+    """Move the saved state into the state files of `workers` workers.
+
+    Users are split between the shard files by id, so the files written with
+    another WORKERS hold the wrong users. The files of the last run are merged
+    and split again, and every state file the new layout does not use is
+    removed, so the files of older layouts never come back with stale pairs.
+    Does nothing when the files already match `workers`.
+    """
+    root, ext = os.path.splitext(path)
+    found = [file for file in glob.glob(f"{glob.escape(root)}-*{ext}")
+             if re.fullmatch(r"\d+", file[len(root) + 1:len(file) - len(ext)])]
+    if os.path.exists(path):
+        found.append(path)
+    if not found:
+        return
+
+    # Opening a file can checkpoint its WAL, take the write times first
+    written = {file: os.path.getmtime(file) for file in found}
+    states = {file: _read_state(file) for file in found}
+    # The unsharded file always had one worker; shard files without a count are grouped together
+    layouts = {}
+    for file, (saved, _, _) in states.items():
+        layouts.setdefault(1 if saved is None and file == path else saved, []).append(file)
+    # The layout of the most recently written file that holds any state is the last run's,
+    # the others are stale
+    latest = max(found, key=lambda file: (bool(states[file][1] or states[file][2]), written[file]))
+    saved = next(count for count, files in layouts.items() if latest in files)
+    files = state_files(path, workers)
+    if saved == workers and set(found) <= set(files):
+        return
+
+    fsm = [row for file in layouts[saved] for row in states[file][1]]
+    matches = [row for file in layouts[saved] for row in states[file][2]]
+
+    # The new files are written in full before any old one is replaced or removed
+    for index, file in enumerate(files):
+        with sqlite3.connect(f"{file}.new") as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.execute("DELETE FROM fsm")
+            db.execute("DELETE FROM matches")
+            db.executemany("INSERT INTO fsm VALUES (?, ?, ?, ?, ?)",
+                           [row for row in fsm if shard_of(int(row[1]), workers) == index])
+            db.executemany("INSERT INTO matches VALUES (?, ?)",
+                           [row for row in matches if shard_of(row[0], workers) == index])
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('workers', ?)", (str(workers),))
+        db.close()
+    for file in files:
+        os.replace(f"{file}.new", file)
+    for file in set(found) - set(files):
+        os.remove(file)
+
+    stale = len(found) - len(layouts[saved])
+    logger.warning(f"Moved {len(fsm)} FSM records and {len(matches)} queue and chat entries from "
+                   f"{len(layouts[saved])} state files to {len(files)} for {workers} workers"
+                   + (f", dropped {stale} stale state files" if stale else ""))
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update(BOT_TOKEN="123456:TEST", STORAGE_BACKEND="memory", WORKERS="1")
+
+import pytest
+from aiogram.utils.exceptions import BotBlocked
+
+import bot
+from webhook import process_update
+
+CONNECTED = "💬 You're now connected! Say hi!"
+
+
+class StubSender:
+    """Records what the handlers send; sends to `blocked` users fail, "connected" notices wait for `hold`."""
+
+    def __init__(self):
+        self.sent = []
+        self.blocked = set()
+        self.hold = None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if text == CONNECTED and self.hold is not None:
+            await self.hold.wait()
+        if chat_id in self.blocked:
+            raise BotBlocked("Forbidden: bot was blocked by the user")
+        self.sent.append((chat_id, text))
+
+    async def answer(self, message, text, **kwargs):
+        await self.send_message(message.chat.id, text, **kwargs)
+
+    async def reply(self, message, text, **kwargs):
+        await self.send_message(message.chat.id, text, **kwargs)
+
+    async def request(self, method, chat_id, **kwargs):
+        await self.send_message(chat_id, kwargs.get('text'))
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    bot.matchmaker._waiting.clear()
+    bot.matchmaker._pairs.clear()
+    bot.storage.data.clear()
+    stub = StubSender()
+    monkeypatch.setattr(bot, 'sender', stub)
+    return stub
+
+
+def update(user_id, text):
+    message = {"message_id": 1, "date": 0, "text": text,
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": "user"}}
+    return {"update_id": 1, "message": message}
+
+
+async def send(user_id, text):
+    await process_update(bot.dp, update(user_id, text))
+
+
+async def state_of(user_id):
+    return await bot.storage.get_state(chat=user_id, user=user_id)
+
+
+def test_pair_ended_while_connecting(sender):
+    async def run():
+        await send(1, "/start")
+        await send(2, "/start")
+        await send(1, "🚀 Start Chat")
+        sender.hold = asyncio.Event()
+        connecting = asyncio.create_task(send(2, "🚀 Start Chat"))
+        await asyncio.sleep(0)
+        # User 1 restarts while the "connected" notices are on their way
+        await send(1, "/start")
+        sender.hold.set()
+        await connecting
+
+        assert bot.matchmaker.partner_of(1) is None
+        assert bot.matchmaker.partner_of(2) is None
+        assert await state_of(1) == bot.ChatState.idle.state
+        assert await state_of(2) == bot.ChatState.idle.state
+
+    asyncio.run(run())
+
+
+def test_partner_unreachable_while_connecting(sender):
+    async def run():
+        await send(1, "/start")
+        await send(2, "/start")
+        await send(1, "🚀 Start Chat")
+        sender.blocked.add(1)
+        await send(2, "🚀 Start Chat")
+
+        assert bot.matchmaker.partner_of(2) is None
+        assert bot.matchmaker.is_waiting(2)
+        assert await state_of(2) == bot.ChatState.searching.state
+        assert sender.sent[-1] == (2, "⚠️ Partner is unavailable, searching again...")
+        assert await state_of(1) is None
+
+        # The next searcher is paired with the user put back in the queue
+        await send(3, "/start")
+        await send(3, "🚀 Start Chat")
+        assert bot.matchmaker.partner_of(2) == 3
+        assert await state_of(2) == bot.ChatState.chatting.state
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("content_types, expected", [
+    ([], "text"),
+    (["photo"], "text and photos"),
+    (["photo", "sticker", "voice"], "text, photos, stickers and voice notes"),
+])
+def test_describe_relayed(content_types, expected):
+    assert bot.describe_relayed(content_types) == expected
@@ -0,0 +1,35 @@
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logs import JsonFormatter, QueueHandler
+
+
+def make_record():
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        return logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, __file__, 1, "failed for %s", ("user 1",), sys.exc_info())
+
+
+def test_prepare_keeps_the_exception_apart():
+    record = QueueHandler(None).prepare(make_record())
+
+    assert record.msg == "failed for user 1" and record.args is None
+    assert record.exc_info is None
+    assert record.exc_type == "ZeroDivisionError"
+    assert record.exc_text.startswith("Traceback")
+    assert "Traceback" not in record.getMessage()
+
+
+def test_json_exc_field():
+    for record in (make_record(), QueueHandler(None).prepare(make_record())):
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry["msg"] == "failed for user 1"
+        assert entry["exc"]["type"] == "ZeroDivisionError"
+        assert entry["exc"]["message"] == "division by zero"
+        assert entry["exc"]["traceback"].startswith("Traceback")
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaker import Matchmaker
+from reaper import CHATTING, Reaper
+from storage import MemoryStorage
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_chat_open_while_partner_talks():
+    async def run():
+        clock = Clock()
+        matchmaker = Matchmaker(clock=clock)
+        storage = MemoryStorage()
+        reaper = Reaper(matchmaker, storage, search_timeout=0, chat_timeout=60, idle_timeout=0, clock=clock)
+        matchmaker.on_relay = reaper.touch
+
+        matchmaker.enqueue(1)
+        matchmaker.enqueue(2)
+        for user_id in (1, 2):
+            await storage.set_state(chat=user_id, user=user_id, state="ChatState:chatting")
+            reaper.touch(user_id)
+
+        # Only user 1 writes, user 2 reads
+        for _ in range(5):
+            clock.now += 30
+            reaper.touch(1)
+            matchmaker.relayed(1, 2)
+            assert await reaper.reap() == []
+
+        clock.now += 61
+        expired = await reaper.reap()
+        assert expired in ([(CHATTING, 1, 2)], [(CHATTING, 2, 1)])
+        assert matchmaker.partner_of(1) is None
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_state(chat=2, user=2) is None
+
+    asyncio.run(run())
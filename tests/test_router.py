@@ -0,0 +1,75 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from aiogram import types
+
+from router import Router
+
+
+def make_router():
+    router = Router(dp=None, default_state="idle")
+    for name, route in [
+        ("start", router.text("/start")),
+        ("start_chat", router.text("Start Chat", state="idle")),
+        ("cancel", router.text("Cancel", state="searching")),
+        ("end_any", router.text("End Chat")),
+        ("relay_text", router.content(types.ContentType.TEXT, state="chatting")),
+        ("relay_photo", router.content(types.ContentType.PHOTO, state="chatting")),
+        ("unsupported_chatting", router.content(state="chatting")),
+        ("sticker_any", router.content(types.ContentType.STICKER)),
+        ("fallback", router.content()),
+    ]:
+        route(name)
+    return router
+
+
+def message(text=None, content=None):
+    data = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+    if content is None:
+        data["text"] = text
+    else:
+        data.update(content)
+    return types.Message(**data)
+
+
+PHOTO = {"photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]}
+STICKER = {"sticker": {"file_id": "s", "file_unique_id": "s", "width": 1, "height": 1,
+                       "is_animated": False, "is_video": False, "type": "regular"}}
+VOICE = {"voice": {"file_id": "v", "file_unique_id": "v", "duration": 1}}
+
+
+@pytest.mark.parametrize("state, msg, expected", [
+    # Text routes for the state, then for any state
+    ("idle", message("Start Chat"), "start_chat"),
+    ("searching", message("Cancel"), "cancel"),
+    ("chatting", message("End Chat"), "end_any"),
+    # A button of another state is relayed as text, not run
+    ("chatting", message("Start Chat"), "relay_text"),
+    ("chatting", message("Cancel"), "relay_text"),
+    ("chatting", message("hello"), "relay_text"),
+    # Content: (state, type), (state, any), (any state, type), (any state, any)
+    ("chatting", message(content=PHOTO), "relay_photo"),
+    ("chatting", message(content=VOICE), "unsupported_chatting"),
+    ("chatting", message(content=STICKER), "unsupported_chatting"),
+    ("idle", message(content=STICKER), "sticker_any"),
+    ("idle", message(content=PHOTO), "fallback"),
+    ("idle", message("hello"), "fallback"),
+    # No state routes as the default state
+    (None, message("Start Chat"), "start_chat"),
+    (None, message("Cancel"), "fallback"),
+])
+def test_resolve(state, msg, expected):
+    assert make_router().resolve(state, msg) == expected
+
+
+@pytest.mark.parametrize("text", ["/start", "/START", "/start@ChatBot", "/start payload", "/start@ChatBot payload"])
+def test_commands_are_normalized(text):
+    for state in ("idle", "searching", "chatting", None):
+        assert make_router().resolve(state, message(text)) == "start"
+
+
+def test_unknown_command_is_not_a_button():
+    assert make_router().resolve("chatting", message("/stop")) == "relay_text"
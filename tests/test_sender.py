@@ -0,0 +1,170 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+
+from sender import GLOBAL_FLOOD_CHATS, RELAY, REPLY, SendScheduler, TokenBucket
+
+
+class FakeBot:
+    """Records the messages sent; `errors[chat_id]` lists the exceptions the next sends to it raise."""
+
+    def __init__(self):
+        self.sent = []
+        self.errors = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+        return text
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2)
+    now = bucket.stamp
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+    assert not bucket.is_full(now + 0.5)
+    assert bucket.is_full(now + 1)
+
+    bucket.pause(now + 1, 3)
+    assert bucket.delay(now + 1) == pytest.approx(3)
+
+
+def test_chat_messages_in_order():
+    async def main():
+        bot = FakeBot()
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        await asyncio.gather(*(sender.send_message(1, f"message {i}") for i in range(10)))
+        await sender.close()
+        assert bot.sent == [(1, f"message {i}") for i in range(10)]
+        assert sender.sent == 10 and sender.pending == 0
+
+    run(main())
+
+
+def test_chat_rate_limit():
+    async def main():
+        bot = FakeBot()
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=20, chat_burst=1)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(sender.send_message(1, "hi") for _ in range(4)))
+        # One right away, then one every 1/20 s
+        assert loop.time() - start >= 0.14
+        await sender.close()
+
+    run(main())
+
+
+def test_relay_goes_before_reply():
+    async def main():
+        bot = FakeBot()
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        await asyncio.gather(
+            sender.send_message(1, "menu", priority=REPLY),
+            sender.send_message(2, "relay", priority=RELAY),
+        )
+        await sender.close()
+        assert bot.sent == [(2, "relay"), (1, "menu")]
+
+    run(main())
+
+
+def test_retry_after_retries_the_chat():
+    async def main():
+        bot = FakeBot()
+        bot.errors[1] = [RetryAfter(0)]
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        assert await sender.send_message(1, "hi") == "hi"
+        await sender.close()
+        assert sender.retried == 1 and sender.failed == 0
+
+    run(main())
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def main():
+        bot = FakeBot()
+        bot.errors[1] = [RetryAfter(0) for _ in range(3)]
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1, max_retries=2)
+        with pytest.raises(RetryAfter):
+            await sender.send_message(1, "hi")
+        # The chat is not stuck behind the failed message
+        assert await sender.send_message(1, "again") == "again"
+        await sender.close()
+        assert sender.retried == 2 and sender.failed == 1
+
+    run(main())
+
+
+def test_other_errors_are_raised():
+    async def main():
+        bot = FakeBot()
+        bot.errors[1] = [BotBlocked("Forbidden: bot was blocked by the user")]
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        with pytest.raises(BotBlocked):
+            await sender.send_message(1, "hi")
+        await sender.close()
+        assert sender.retried == 0 and sender.failed == 1
+
+    run(main())
+
+
+def test_flood_in_many_chats_pauses_all_sends():
+    async def main():
+        bot = FakeBot()
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        chats = range(1, GLOBAL_FLOOD_CHATS + 1)
+        for chat_id in chats:
+            bot.errors[chat_id] = [RetryAfter(1)]
+        sends = [asyncio.create_task(sender.send_message(chat_id, "hi")) for chat_id in chats]
+        await asyncio.sleep(0.1)
+        assert sender._global.delay(time.monotonic()) > 0.5
+        for send in sends:
+            send.cancel()
+        await sender.close(timeout=0)
+
+    run(main())
+
+
+def test_flood_in_one_chat_pauses_only_that_chat():
+    async def main():
+        bot = FakeBot()
+        bot.errors[1] = [RetryAfter(1)]
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        flooded = asyncio.create_task(sender.send_message(1, "hi"))
+        await asyncio.sleep(0.01)
+        assert await asyncio.wait_for(sender.send_message(2, "hi"), 0.5) == "hi"
+        assert not flooded.done()
+        flooded.cancel()
+        await sender.close(timeout=0)
+
+    run(main())
+
+
+def test_idle_chats_are_pruned():
+    async def main():
+        bot = FakeBot()
+        sender = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=1)
+        await sender.send_message(1, "hi")
+        await asyncio.sleep(0.01)
+        sender._next_prune = 0
+        await sender.send_message(2, "hi")
+        await sender.close()
+        assert 1 not in sender._chats
+
+    run(main())
@@ -0,0 +1,204 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shards import Broker, RemoteMatchmaker, shard_of
+
+
+def update(user_id):
+    return {"update_id": 1, "message": {"from": {"id": user_id}}}
+
+
+class StubWorker:
+    """Collects what a shard sends to the broker and the users it tells they are paired."""
+
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+        self.sent = []
+        self.paired = []
+        self.unpaired = []
+        self.matchmaker = None
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def spawn(self, coro):
+        # on_pair never awaits here, one step runs it to the end
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+    async def on_pair(self, user_id, partner_id):
+        self.paired.append(user_id)
+
+    async def on_unpair(self, user_id, partner_id):
+        self.unpaired.append(user_id)
+
+
+class StubConn:
+    def __init__(self):
+        self.inbox = []
+        self.closed = False
+
+    def send(self, message):
+        if self.closed:
+            raise BrokenPipeError(32, "Broken pipe")
+        self.inbox.append(message)
+
+
+class Cluster:
+    """A broker and its shards wired together without processes or pipes."""
+
+    def __init__(self, workers):
+        self.broker = Broker(dp=None, workers=workers)
+        self.broker._conns = [StubConn() for _ in range(workers)]
+        self.workers = [StubWorker(index, workers) for index in range(workers)]
+        self.shards = [RemoteMatchmaker(worker, on_pair=worker.on_pair, on_unpair=worker.on_unpair)
+                       for worker in self.workers]
+
+    def shard(self, user_id):
+        return self.shards[shard_of(user_id, len(self.shards))]
+
+    def to_broker(self):
+        """Deliver everything the shards sent to the broker."""
+        for index, worker in enumerate(self.workers):
+            messages, worker.sent = worker.sent, []
+            for message in messages:
+                self.broker._handle(index, message)
+
+    def to_shards(self):
+        """Deliver everything the broker sent to the shards."""
+        for shard, conn in zip(self.shards, self.broker._conns):
+            messages, conn.inbox = conn.inbox, []
+            for message in messages:
+                shard.apply(message)
+
+    def settle(self):
+        while any(worker.sent for worker in self.workers) or any(conn.inbox for conn in self.broker._conns):
+            self.to_broker()
+            self.to_shards()
+
+
+def test_pair_across_shards():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.settle()
+
+    assert cluster.shard(1).partner_of(1) == 2
+    assert cluster.shard(2).partner_of(2) == 1
+    assert cluster.workers[1].paired == [1]
+    assert cluster.workers[0].paired == [2]
+
+
+def test_cancel_while_pairing_same_shard():
+    cluster = Cluster(workers=1)
+    shard = cluster.shards[0]
+    shard.enqueue(2)
+    shard.enqueue(1)
+    cluster.to_broker()
+    # The broker paired them, the cancel was sent before the shard heard of it
+    shard.cancel(2)
+    cluster.to_shards()
+    cluster.settle()
+
+    assert shard.partner_of(1) is None
+    assert shard.partner_of(2) is None
+    assert cluster.workers[0].paired == []
+    # The surviving user is searching again, at the front of the broker's queue
+    assert shard.is_waiting(1)
+    assert not shard.is_waiting(2)
+    assert cluster.broker.queue.is_waiting(1)
+
+    shard.enqueue(3)
+    cluster.settle()
+    assert shard.partner_of(1) == 3
+    assert sorted(cluster.workers[0].paired) == [1, 3]
+
+
+def test_cancel_while_pairing_across_shards():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.to_broker()
+    cluster.shard(2).cancel(2)
+    # User 1's shard accepts the offer before the broker hears of the cancel
+    cluster.to_shards()
+    cluster.settle()
+
+    assert cluster.shard(1).partner_of(1) is None
+    assert cluster.shard(2).partner_of(2) is None
+    assert cluster.workers[0].paired == cluster.workers[1].paired == []
+    assert cluster.shard(1).is_waiting(1)
+    assert cluster.broker.queue.is_waiting(1)
+
+
+def test_cancel_and_search_again_while_pairing():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.to_broker()
+    # User 2 cancels and searches again before the first offer arrives
+    cluster.shard(2).cancel(2)
+    cluster.shard(2).enqueue(2)
+    cluster.settle()
+
+    assert cluster.shard(1).partner_of(1) == 2
+    assert cluster.shard(2).partner_of(2) == 1
+    assert cluster.workers[1].paired == [1]
+    assert cluster.workers[0].paired == [2]
+    assert not cluster.broker._pending
+
+
+def test_relay_reported_to_partner_shard():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.settle()
+    relayed = []
+    cluster.shard(2).on_relay = relayed.append
+
+    cluster.shard(1).relayed(1, 2)
+    # Later relays within ACTIVITY_INTERVAL are not reported again
+    cluster.shard(1).relayed(1, 2)
+    cluster.settle()
+    assert relayed == [2]
+
+
+def test_unpair_across_shards():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.settle()
+
+    assert cluster.shard(1).unpair(1) == 2
+    cluster.settle()
+    assert cluster.shard(2).partner_of(2) is None
+    assert cluster.workers[0].unpaired == [2]
+    assert cluster.workers[1].unpaired == []
+
+
+def test_dead_shard():
+    cluster = Cluster(workers=2)
+    cluster.shard(2).enqueue(2)
+    cluster.shard(1).enqueue(1)
+    cluster.to_broker()
+    # The broker offered the pair, then user 2's shard died
+    cluster.broker._conns[0].closed = True
+    cluster.broker.feed(update(2))
+
+    stats = cluster.broker.stats()
+    assert stats["dead_shards"] == [0]
+    assert stats["dropped_updates"] == 1
+    assert stats["status"] == "degraded"
+    # User 1 is not left waiting on the offer
+    cluster.settle()
+    assert cluster.shard(1).partner_of(1) is None
+    assert cluster.broker.queue.is_waiting(1)
+
+    cluster.broker.feed(update(3))
+    assert cluster.broker._conns[1].inbox[-1][0] == 'update'
+    assert cluster.broker.stats()["dropped_updates"] == 1
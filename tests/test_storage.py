@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from matchmaker import Matchmaker
+from storage import SQLiteStorage, rebalance, shard_path
+
+
+def save(path, workers, states, waiting=(), pairs=()):
+    """Write a state file the way a worker of a `workers` layout does."""
+    async def write():
+        storage = SQLiteStorage(path, workers=workers)
+        matchmaker = Matchmaker()
+        storage.attach(matchmaker)
+        for user_id, state in states.items():
+            await storage.set_state(chat=user_id, user=user_id, state=state)
+        for user_id, partner_id in pairs:
+            matchmaker.enqueue(user_id)
+            matchmaker.enqueue(partner_id)
+        for user_id in waiting:
+            matchmaker.enqueue(user_id)
+        await storage.close()
+        await storage.wait_closed()
+    asyncio.run(write())
+
+
+def load(path):
+    storage = SQLiteStorage(path)
+    matchmaker = Matchmaker()
+    storage.attach(matchmaker)
+    states = {int(user): record['state'] for records in storage.data.values() for user, record in records.items()}
+    asyncio.run(storage.wait_closed())
+    return states, matchmaker
+
+
+def test_rebalance_to_more_workers(tmp_path):
+    path = str(tmp_path / "chatbot.db")
+    save(shard_path(path, 0), 2, {2: "searching", 4: "idle"}, waiting=[2])
+    save(shard_path(path, 1), 2, {1: "chatting", 3: "idle"})
+    rebalance(path, 3)
+
+    assert sorted(os.listdir(tmp_path)) == ["chatbot-0.db", "chatbot-1.db", "chatbot-2.db"]
+    assert load(shard_path(path, 0))[0] == {3: "idle"}
+    assert load(shard_path(path, 1))[0] == {1: "chatting", 4: "idle"}
+    states, matchmaker = load(shard_path(path, 2))
+    assert states == {2: "searching"}
+    assert matchmaker.is_waiting(2)
+
+
+def test_rebalance_drops_stale_layout(tmp_path):
+    path = str(tmp_path / "chatbot.db")
+    # Files of an older run with 2 workers, then a run with 1
+    save(shard_path(path, 0), 2, {2: "chatting"})
+    save(shard_path(path, 1), 2, {1: "chatting"})
+    os.utime(shard_path(path, 0), (0, 0))
+    os.utime(shard_path(path, 1), (0, 0))
+    save(path, 1, {5: "searching"}, waiting=[5])
+    rebalance(path, 2)
+
+    assert sorted(os.listdir(tmp_path)) == ["chatbot-0.db", "chatbot-1.db"]
+    assert load(shard_path(path, 0))[0] == {}
+    states, matchmaker = load(shard_path(path, 1))
+    assert states == {5: "searching"}
+    assert matchmaker.is_waiting(5)
+    assert matchmaker.partner_of(1) is None
+
+
+def test_rebalance_same_layout_is_untouched(tmp_path):
+    path = str(tmp_path / "chatbot.db")
+    save(path, 1, {1: "idle"})
+    written = os.path.getmtime(path)
+    rebalance(path, 1)
+
+    assert os.listdir(tmp_path) == ["chatbot.db"]
+    assert os.path.getmtime(path) == written
+
+
+def test_state_survives_restart(tmp_path):
+    path = str(tmp_path / "chatbot.db")
+    save(path, 1, {1: "chatting", 2: "chatting", 3: "searching", 4: "idle"}, waiting=[3], pairs=[(1, 2)])
+
+    states, matchmaker = load(path)
+    assert states == {1: "chatting", 2: "chatting", 3: "searching", 4: "idle"}
+    assert matchmaker.partner_of(1) == 2 and matchmaker.partner_of(2) == 1
+    assert matchmaker.is_waiting(3)
+    assert not matchmaker.is_waiting(4)
+
+
+def test_failed_flush_is_written_again(tmp_path, monkeypatch):
+    path = str(tmp_path / "chatbot.db")
+
+    async def run():
+        storage = SQLiteStorage(path, flush_interval=60)
+        matchmaker = Matchmaker()
+        storage.attach(matchmaker)
+        await storage.set_state(chat=1, user=1, state="searching")
+        matchmaker.enqueue(1)
+
+        write = storage._write
+        def locked(*args):
+            raise sqlite3.OperationalError("database is locked")
+        monkeypatch.setattr(storage, '_write', locked)
+        with pytest.raises(sqlite3.OperationalError):
+            await storage.flush()
+
+        monkeypatch.setattr(storage, '_write', write)
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(run())
+    states, matchmaker = load(path)
+    assert states == {1: "searching"}
+    assert matchmaker.is_waiting(1)
+
+
+def test_flusher_survives_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / "chatbot.db")
+
+    async def run():
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        storage.attach(Matchmaker())
+        # Not JSON-serializable: the record is skipped, not the whole flush
+        await storage.set_data(chat=1, user=1, data={"bad": object()})
+        await storage.set_state(chat=2, user=2, state="idle")
+
+        flush = storage.flush
+        calls = []
+        async def failing():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("unexpected")
+            await flush()
+        monkeypatch.setattr(storage, 'flush', failing)
+        await asyncio.sleep(0.1)
+        assert len(calls) > 1 and not storage._flusher.done()
+
+        monkeypatch.setattr(storage, 'flush', flush)
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(run())
+    assert load(path)[0] == {2: "idle"}
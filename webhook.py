@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def process_update(dp, data):
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    try:
+        await dp.process_update(types.Update(**data))
+    except Exception:
+        logger.exception(f"Failed to process update {data.get('update_id')}")
+
+
+def make_app(dp, path="/webhook", secret=None, feed_update=None, stats=None):
+    """aiohttp app that acknowledges Telegram at once and handles updates in the background.
+
+    `feed_update(data)` returns the coroutine that handles one raw update;
+    by default the update goes straight to `dp`. `stats()` may return extra
+    fields for the health endpoint; a "status" other than "ok" answers 503.
+    """
+    if feed_update is None:
+        feed_update = lambda data: process_update(dp, data)
+
+    app = web.Application()
+    app['dp'] = dp
+    app['tasks'] = set()
+
+    async def handle_update(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        task = asyncio.create_task(feed_update(data))
+        app['tasks'].add(task)
+        task.add_done_callback(app['tasks'].discard)
+        return web.Response()
+
+    async def health(request):
+        status = {"status": "ok", "pending_updates": len(app['tasks'])}
+        if stats is not None:
+            status.update(stats())
+        return web.json_response(status, status=200 if status["status"] == "ok" else 503)
+
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/health", health)
+    return app
+
+
+async def _drain(app):
+    if app['tasks']:
+        await asyncio.wait(list(app['tasks']), timeout=10)
+
+
+def run_webhook(dp, url, path="/webhook", secret=None, host="0.0.0.0", port=8080, skip_updates=True,
+                stats=None, feed_update=None, on_startup=None, on_shutdown=None):
+    app = make_app(dp, path, secret, feed_update=feed_update, stats=stats)
+    startup_callback, shutdown_callback = on_startup, on_shutdown
+
+    async def on_startup(app):
+        if startup_callback is not None:
+            await startup_callback(dp)
+        await dp.bot.set_webhook(url, drop_pending_updates=skip_updates, secret_token=secret)
+        logger.info(f"Webhook set to {url}")
+
+    async def on_shutdown(app):
+        await _drain(app)
+        if shutdown_callback is not None:
+            await shutdown_callback(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    web.run_app(app, host=host, port=port)